@@ -15,6 +15,11 @@ EXTRA_TEST_RECORD_DEPENDENCIES = ["Item"]
 
 
 class TestAccountingPeriod(IntegrationTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.exempted_role_test_user = create_user("test_accounting_period@example.com", "Accounts User")
+
 	def test_overlap(self):
 		ap1 = create_accounting_period(
 			start_date="2018-04-01", end_date="2018-06-30", company="Wind Power LLC"
@@ -46,30 +51,12 @@ class TestAccountingPeriod(IntegrationTestCase):
 		)
 		ap.save()
 
-		# Create users
-		users = frappe.get_all("User", filters={"email": ["like", "test%"]}, limit=1)
-		user = None
-
-		if users[0].name:
-			user = frappe.get_doc("User", users[0].name)
-		else:
-			user = frappe.get_doc(
-				{
-					"doctype": "User",
-					"email": "test1@example.com",
-					"first_name": "Test1",
-				}
-			)
-			user.insert()
-
-		user.roles = []
-		user.append("roles", {"role": "Accounts User"})
+		user = self.exempted_role_test_user
 
 		# ---- Non-exempted user should FAIL ----
-		user.save(ignore_permissions=True)
-		frappe.clear_cache(user=user.name)
+		set_role(user, "Accounts Manager", enabled=False)
 
-		frappe.set_user(user.name)
+		frappe.set_user(user)
 		posting_date = "2025-12-11"
 		doc = create_sales_invoice(
 			do_not_save=1,
@@ -80,9 +67,7 @@ class TestAccountingPeriod(IntegrationTestCase):
 			doc.submit()
 
 		# ---- Exempted role should PASS ----
-		user.append("roles", {"role": "Accounts Manager"})
-		user.save(ignore_permissions=True)
-		frappe.clear_cache(user=user.name)
+		set_role(user, "Accounts Manager", enabled=True)
 
 		doc = create_sales_invoice(do_not_save=1, posting_date=posting_date)
 
@@ -90,8 +75,8 @@ class TestAccountingPeriod(IntegrationTestCase):
 		self.assertEqual(doc.docstatus, 1)
 
 	def tearDown(self):
-		for d in frappe.get_all("Accounting Period"):
-			frappe.delete_doc("Accounting Period", d.name)
+		frappe.db.delete("Closed Document", {"parenttype": "Accounting Period"})
+		frappe.db.delete("Accounting Period")
 
 
 def create_accounting_period(**args):
@@ -106,3 +91,29 @@ def create_accounting_period(**args):
 	accounting_period.exempted_role = args.exempted_role or ""
 
 	return accounting_period
+
+
+def create_user(email, *roles):
+	if not frappe.db.exists("User", email):
+		user = frappe.get_doc({"doctype": "User", "email": email, "first_name": email.split("@")[0]})
+		user.extend("roles", [{"role": role} for role in roles])
+		user.insert(ignore_permissions=True)
+
+	return email
+
+
+def set_role(user, role, enabled):
+	"""Grant or revoke a role by writing `Has Role` directly, without saving the User"""
+	frappe.db.delete("Has Role", {"parent": user, "parenttype": "User", "role": role})
+	if enabled:
+		frappe.get_doc(
+			{
+				"doctype": "Has Role",
+				"parent": user,
+				"parenttype": "User",
+				"parentfield": "roles",
+				"role": role,
+			}
+		).db_insert()
+
+	frappe.clear_cache(user=user)
@@ -12,6 +12,10 @@ from frappe.utils import cint
 
 from erpnext.accounts.utils import sync_auto_reconcile_config
 
+# settings that are mirrored into global defaults
+DEFAULT_FIELDS = frozenset(("add_taxes_from_item_tax_template", "enable_common_party_accounting"))
+CACHE_AFFECTING_FIELDS = DEFAULT_FIELDS | {"show_payment_schedule_in_print"}
+
 
 class AccountsSettings(Document):
 	# begin: auto-generated types
@@ -78,28 +82,23 @@ class AccountsSettings(Document):
 
 	def validate(self):
 		self.validate_auto_tax_settings()
-		old_doc = self.get_doc_before_save()
-		clear_cache = False
-
-		if old_doc.add_taxes_from_item_tax_template != self.add_taxes_from_item_tax_template:
-			frappe.db.set_default(
-				"add_taxes_from_item_tax_template", self.get("add_taxes_from_item_tax_template", 0)
-			)
-			clear_cache = True
+		self.validate_stale_days()
 
-		if old_doc.enable_common_party_accounting != self.enable_common_party_accounting:
-			frappe.db.set_default(
-				"enable_common_party_accounting", self.get("enable_common_party_accounting", 0)
-			)
-			clear_cache = True
+		old_doc = self.get_doc_before_save()
+		changed_fields = {
+			fieldname for fieldname in CACHE_AFFECTING_FIELDS if old_doc.get(fieldname) != self.get(fieldname)
+		}
 
-		self.validate_stale_days()
+		for fieldname in changed_fields & DEFAULT_FIELDS:
+			frappe.db.set_default(fieldname, self.get(fieldname, 0))
 
-		if old_doc.show_payment_schedule_in_print != self.show_payment_schedule_in_print:
+		if "show_payment_schedule_in_print" in changed_fields:
 			self.enable_payment_schedule_in_print()
 
-		if clear_cache:
-			frappe.clear_cache()
+		if changed_fields & DEFAULT_FIELDS:
+			# set_default already evicts the defaults cache,
+			# only the cached boot info has to be rebuilt for these settings
+			frappe.cache.delete_keys("bootinfo")
 
 		self.validate_and_sync_auto_reconcile_config()
 
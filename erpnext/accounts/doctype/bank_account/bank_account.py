@@ -65,33 +65,41 @@ class BankAccount(Document):
 			self.validate_account()
 
 	def validate_account(self):
-		if accounts := frappe.db.get_all(
-			"Bank Account", filters={"account": self.account, "name": ["!=", self.name]}, as_list=1
-		):
-			frappe.throw(
-				_("'{0}' account is already used by {1}. Use another account.").format(
-					frappe.bold(self.account),
-					frappe.bold(comma_and([get_link_to_form(self.doctype, x[0]) for x in accounts])),
-				)
+		filters = {"account": self.account, "name": ["!=", self.name]}
+		if not frappe.db.exists("Bank Account", filters):
+			return
+
+		accounts = frappe.db.get_all("Bank Account", filters=filters, as_list=1)
+		frappe.throw(
+			_("'{0}' account is already used by {1}. Use another account.").format(
+				frappe.bold(self.account),
+				frappe.bold(comma_and([get_link_to_form(self.doctype, x[0]) for x in accounts])),
 			)
+		)
 
 	def update_default_bank_account(self):
 		if self.is_default and not self.disabled:
-			frappe.db.set_value(
-				"Bank Account",
+			frappe.db.sql(
+				"""
+				update `tabBank Account`
+				set is_default = 0
+				where ifnull(party_type, '') = ifnull(%(party_type)s, '')
+					and ifnull(party, '') = ifnull(%(party)s, '')
+					and is_company_account = %(is_company_account)s
+					and ifnull(company, '') = ifnull(%(company)s, '')
+					and is_default = 1 and disabled = 0 and name != %(name)s
+				""",
 				{
 					"party_type": self.party_type,
 					"party": self.party,
 					"is_company_account": self.is_company_account,
 					"company": self.company,
-					"is_default": 1,
-					"disabled": 0,
+					"name": self.name,
 				},
-				"is_default",
-				0,
 			)
 
 
+@frappe.request_cache
 def get_party_bank_account(party_type, party):
 	return frappe.db.get_value(
 		"Bank Account",
@@ -100,18 +108,24 @@ def get_party_bank_account(party_type, party):
 	)
 
 
+@frappe.request_cache
 def get_default_company_bank_account(company, party_type, party):
-	default_company_bank_account = frappe.db.get_value(party_type, party, "default_bank_account")
-	if default_company_bank_account:
-		if company != frappe.get_cached_value("Bank Account", default_company_bank_account, "company"):
-			default_company_bank_account = None
+	# party's default bank account, if it belongs to the company
+	bank_account = frappe.qb.DocType("Bank Account")
+	party_doctype = frappe.qb.DocType(party_type)
+	default_company_bank_account = (
+		frappe.qb.from_(party_doctype)
+		.inner_join(bank_account)
+		.on(bank_account.name == party_doctype.default_bank_account)
+		.select(bank_account.name)
+		.where((party_doctype.name == party) & (bank_account.company == company))
+		.run()
+	)
 
-	if not default_company_bank_account:
-		default_company_bank_account = frappe.db.get_value(
-			"Bank Account", {"company": company, "is_company_account": 1, "is_default": 1}
-		)
+	if default_company_bank_account:
+		return default_company_bank_account[0][0]
 
-	return default_company_bank_account
+	return frappe.db.get_value("Bank Account", {"company": company, "is_company_account": 1, "is_default": 1})
 
 
 @frappe.whitelist()
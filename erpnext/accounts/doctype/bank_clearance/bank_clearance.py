@@ -2,15 +2,78 @@
 # License: GNU General Public License v3. See license.txt
 
 
+import itertools
+from collections import defaultdict
+
 import frappe
 from frappe import _, msgprint
 from frappe.model.document import Document
-from frappe.query_builder.custom import ConstantColumn
 from frappe.utils import cint, flt, fmt_money, getdate
-from pypika import Order
+from frappe.utils.caching import site_cache
 
 import erpnext
 
+# Single round trip, sorted by the database. The POS and reconciled branches are
+# toggled through bound values so the query text is the same for every call.
+CLEARANCE_ENTRIES_QUERY = """
+	select
+		"Payment Entry" as payment_document, pe.name as payment_entry,
+		pe.reference_no as cheque_number, pe.reference_date as cheque_date,
+		if(pe.paid_from=%(account)s, -(pe.paid_amount + if(pe.payment_type = 'Pay' and %(company_currency)s = pe.paid_from_account_currency, pe.base_total_taxes_and_charges, pe.total_taxes_and_charges)), pe.received_amount + pe.total_taxes_and_charges) as net_amount,
+		pe.posting_date, ifnull(pe.party,if(pe.paid_from=%(account)s,pe.paid_to,pe.paid_from)) as against_account, pe.clearance_date,
+		if(pe.paid_to=%(account)s, pe.paid_to_account_currency, pe.paid_from_account_currency) as account_currency
+	from `tabPayment Entry` as pe
+	where
+		(pe.paid_from=%(account)s or pe.paid_to=%(account)s) and pe.docstatus=1
+		and pe.posting_date >= %(from)s and pe.posting_date <= %(to)s
+		and (%(include_reconciled_entries)s or pe.clearance_date IS NULL or pe.clearance_date='0000-00-00')
+
+	union all
+
+	select
+		"Journal Entry" as payment_document, t1.name as payment_entry,
+		t1.cheque_no as cheque_number, t1.cheque_date,
+		sum(t2.debit_in_account_currency) - sum(t2.credit_in_account_currency) as net_amount,
+		t1.posting_date, t2.against_account, t1.clearance_date, t2.account_currency
+	from
+		`tabJournal Entry` t1, `tabJournal Entry Account` t2
+	where
+		t2.parent = t1.name and t2.account = %(account)s and t1.docstatus=1
+		and t1.posting_date >= %(from)s and t1.posting_date <= %(to)s
+		and ifnull(t1.is_opening, 'No') = 'No'
+		and (%(include_reconciled_entries)s or t1.clearance_date IS NULL or t1.clearance_date='0000-00-00')
+	group by t2.account, t1.name
+
+	union all
+
+	select
+		"Sales Invoice" as payment_document, si.name as payment_entry,
+		si_payment.reference_no as cheque_number, null as cheque_date,
+		si_payment.amount as net_amount,
+		si.posting_date, si.customer as against_account, si_payment.clearance_date,
+		%(account_currency)s as account_currency
+	from `tabSales Invoice Payment` si_payment
+	join `tabSales Invoice` si on si_payment.parent = si.name
+	where
+		%(include_pos_transactions)s and si.docstatus=1 and si_payment.account = %(account)s
+		and si.posting_date >= %(from)s and si.posting_date <= %(to)s
+
+	union all
+
+	select
+		"Purchase Invoice" as payment_document, pi.name as payment_entry,
+		null as cheque_number, null as cheque_date,
+		-pi.paid_amount as net_amount,
+		pi.posting_date, pi.supplier as against_account, pi.clearance_date,
+		%(account_currency)s as account_currency
+	from `tabPurchase Invoice` pi
+	where
+		%(include_pos_transactions)s and pi.docstatus=1 and pi.cash_bank_account = %(account)s
+		and pi.posting_date >= %(from)s and pi.posting_date <= %(to)s
+
+	order by posting_date ASC, payment_entry DESC
+"""
+
 form_grid_templates = {"journal_entries": "templates/form_grid/bank_reconciliation_grid.html"}
 
 
@@ -45,13 +108,11 @@ class BankClearance(Document):
 		if not self.account:
 			frappe.throw(_("Account is mandatory to get payment entries"))
 
-		entries = []
-
-		# get entries from all the apps
+		# get entries from all the apps, hooks are not required to return them ordered
 		precision = cint(frappe.db.get_default("currency_precision")) or 2
-		for method_name in frappe.get_hooks("get_payment_entries_for_bank_clearance"):
-			entries += (
-				frappe.get_attr(method_name)(
+		entries = sorted(
+			itertools.chain.from_iterable(
+				method(
 					self.from_date,
 					self.to_date,
 					self.account,
@@ -59,33 +120,31 @@ class BankClearance(Document):
 					self.include_reconciled_entries,
 					self.include_pos_transactions,
 				)
-				or []
-			)
-
-		entries = sorted(
-			entries,
+				or ()
+				for method in get_payment_entry_methods()
+			),
 			key=lambda k: getdate(k["posting_date"]),
 		)
 
-		self.set("payment_entries", [])
 		default_currency = erpnext.get_default_currency()
+		dr, cr = _("Dr"), _("Cr")
 
+		payment_entries = []
 		for d in entries:
-			row = self.append("payment_entries", {})
-
-			amount = flt(d.get("debit", 0)) - flt(d.get("credit", 0))
+			if "net_amount" in d:
+				amount = d.pop("net_amount")
+			else:
+				amount = flt(d.pop("debit", 0)) - flt(d.pop("credit", 0))
+			account_currency = d.pop("account_currency", None) or default_currency
 
-			if not d.get("account_currency"):
-				d.account_currency = default_currency
+			d.amount = fmt_money(abs(amount), precision, account_currency) + " " + (dr if amount > 0 else cr)
+			if isinstance(d.posting_date, str):
+				d.posting_date = getdate(d.posting_date)
 
-			formatted_amount = fmt_money(abs(amount), precision, d.account_currency)
-			d.amount = formatted_amount + " " + (_("Dr") if amount > 0 else _("Cr"))
-			d.posting_date = getdate(d.posting_date)
+			payment_entries.append(d)
 
-			d.pop("credit")
-			d.pop("debit")
-			d.pop("account_currency")
-			row.update(d)
+		# the table is only sent back to the form and never saved, so it is built in one go
+		self.set("payment_entries", payment_entries)
 
 	@frappe.whitelist()
 	def update_clearance_date(self):
@@ -132,169 +191,88 @@ class BankClearance(Document):
 			msgprint(_("Clearance Date not mentioned"))
 			return
 
+		entries_by_doctype = defaultdict(list)
 		for d in entries_to_update:
-			if d.payment_document == "Sales Invoice":
-				old_clearance_date = frappe.db.get_value(
-					"Sales Invoice Payment",
-					{
-						"parent": d.payment_entry,
-						"account": self.account,
-						"amount": [">", 0],
-					},
-					"clearance_date",
-				)
-				if d.clearance_date or old_clearance_date:
+			entries_by_doctype[d.payment_document].append(d)
+
+		for payment_document, entries in entries_by_doctype.items():
+			old_clearance_dates = get_old_clearance_dates(payment_document, entries, self.account)
+			for d in entries:
+				old_clearance_date = old_clearance_dates.get(d.payment_entry)
+				if not (d.clearance_date or old_clearance_date):
+					continue
+
+				if payment_document == "Sales Invoice":
 					frappe.db.set_value(
 						"Sales Invoice Payment",
-						{"parent": d.payment_entry, "account": self.get("account"), "amount": [">", 0]},
+						{"parent": d.payment_entry, "account": self.account, "amount": [">", 0]},
 						"clearance_date",
 						d.clearance_date,
 					)
-					sales_invoice = frappe.get_lazy_doc("Sales Invoice", d.payment_entry)
-					sales_invoice.add_comment(
-						"Comment",
-						_("Clearance date changed from {0} to {1} via Bank Clearance Tool").format(
-							old_clearance_date, d.clearance_date
-						),
-					)
-
-			else:
-				payment_entry = frappe.get_lazy_doc(d.payment_document, d.payment_entry)
-				old_clearance_date = payment_entry.clearance_date
-
-				if d.clearance_date or old_clearance_date:
+					payment_entry = frappe.get_lazy_doc("Sales Invoice", d.payment_entry)
+				else:
+					payment_entry = frappe.get_lazy_doc(payment_document, d.payment_entry)
 					# using db_set to trigger notification
 					payment_entry.db_set("clearance_date", d.clearance_date)
 
-					payment_entry.add_comment(
-						"Comment",
-						_("Clearance date changed from {0} to {1} via Bank Clearance Tool").format(
-							old_clearance_date, d.clearance_date
-						),
-					)
+				payment_entry.add_comment(
+					"Comment",
+					_("Clearance date changed from {0} to {1} via Bank Clearance Tool").format(
+						old_clearance_date, d.clearance_date
+					),
+				)
 
 		self.get_payment_entries()
 		msgprint(_("Clearance Date updated"))
 
 
+@site_cache()
+def get_payment_entry_methods():
+	"""Resolve the `get_payment_entries_for_bank_clearance` hooks once per site"""
+	return tuple(
+		frappe.get_attr(method_name)
+		for method_name in frappe.get_hooks("get_payment_entries_for_bank_clearance")
+	)
+
+
+def get_old_clearance_dates(payment_document, entries, account):
+	"""Return {payment_entry: clearance_date} for all `entries` of a payment document"""
+	names = [d.payment_entry for d in entries]
+
+	if payment_document == "Sales Invoice":
+		si_payment = frappe.qb.DocType("Sales Invoice Payment")
+		return dict(
+			frappe.qb.from_(si_payment)
+			.select(si_payment.parent, si_payment.clearance_date)
+			.where(si_payment.parent.isin(names) & (si_payment.account == account) & (si_payment.amount > 0))
+			.run()
+		)
+
+	return dict(
+		frappe.get_all(
+			payment_document,
+			filters={"name": ["in", names]},
+			fields=["name", "clearance_date"],
+			as_list=True,
+		)
+	)
+
+
 def get_payment_entries_for_bank_clearance(
 	from_date, to_date, account, bank_account, include_reconciled_entries, include_pos_transactions
 ):
-	entries = []
-
-	condition = ""
-	pe_condition = ""
-	if not include_reconciled_entries:
-		condition = "and (clearance_date IS NULL or clearance_date='0000-00-00')"
-		pe_condition = "and (pe.clearance_date IS NULL or pe.clearance_date='0000-00-00')"
-
-	journal_entries = frappe.db.sql(
-		f"""
-			select
-				"Journal Entry" as payment_document, t1.name as payment_entry,
-				t1.cheque_no as cheque_number, t1.cheque_date,
-				sum(t2.debit_in_account_currency) as debit, sum(t2.credit_in_account_currency) as credit,
-				t1.posting_date, t2.against_account, t1.clearance_date, t2.account_currency
-			from
-				`tabJournal Entry` t1, `tabJournal Entry Account` t2
-			where
-				t2.parent = t1.name and t2.account = %(account)s and t1.docstatus=1
-				and t1.posting_date >= %(from)s and t1.posting_date <= %(to)s
-				and ifnull(t1.is_opening, 'No') = 'No' {condition}
-			group by t2.account, t1.name
-			order by t1.posting_date ASC, t1.name DESC
-		""",
-		{"account": account, "from": from_date, "to": to_date},
-		as_dict=1,
-	)
+	account_currency, company = frappe.get_cached_value("Account", account, ["account_currency", "company"])
 
-	payment_entries = frappe.db.sql(
-		f"""
-			select
-				"Payment Entry" as payment_document, pe.name as payment_entry,
-				pe.reference_no as cheque_number, pe.reference_date as cheque_date,
-				if(pe.paid_from=%(account)s, pe.paid_amount + if(pe.payment_type = 'Pay' and c.default_currency = pe.paid_from_account_currency, pe.base_total_taxes_and_charges, pe.total_taxes_and_charges) , 0) as credit,
-				if(pe.paid_from=%(account)s, 0, pe.received_amount + pe.total_taxes_and_charges) as debit,
-				pe.posting_date, ifnull(pe.party,if(pe.paid_from=%(account)s,pe.paid_to,pe.paid_from)) as against_account, pe.clearance_date,
-				if(pe.paid_to=%(account)s, pe.paid_to_account_currency, pe.paid_from_account_currency) as account_currency
-			from `tabPayment Entry` as pe
-			join `tabCompany` c on c.name = pe.company
-			where
-				(pe.paid_from=%(account)s or pe.paid_to=%(account)s) and pe.docstatus=1
-				and pe.posting_date >= %(from)s and pe.posting_date <= %(to)s
-				{pe_condition}
-			order by
-				pe.posting_date ASC, pe.name DESC
-		""",
+	return frappe.db.sql(
+		CLEARANCE_ENTRIES_QUERY,
 		{
 			"account": account,
 			"from": from_date,
 			"to": to_date,
+			"account_currency": account_currency,
+			"company_currency": erpnext.get_company_currency(company),
+			"include_reconciled_entries": cint(include_reconciled_entries),
+			"include_pos_transactions": cint(include_pos_transactions),
 		},
 		as_dict=1,
 	)
-
-	pos_sales_invoices, pos_purchase_invoices = [], []
-	if include_pos_transactions:
-		si_payment = frappe.qb.DocType("Sales Invoice Payment")
-		si = frappe.qb.DocType("Sales Invoice")
-		acc = frappe.qb.DocType("Account")
-
-		pos_sales_invoices = (
-			frappe.qb.from_(si_payment)
-			.inner_join(si)
-			.on(si_payment.parent == si.name)
-			.inner_join(acc)
-			.on(si_payment.account == acc.name)
-			.select(
-				ConstantColumn("Sales Invoice").as_("payment_document"),
-				si.name.as_("payment_entry"),
-				si_payment.reference_no.as_("cheque_number"),
-				si_payment.amount.as_("debit"),
-				si.posting_date,
-				si.customer.as_("against_account"),
-				si_payment.clearance_date,
-				acc.account_currency,
-				ConstantColumn(0).as_("credit"),
-			)
-			.where(
-				(si.docstatus == 1)
-				& (si_payment.account == account)
-				& (si.posting_date >= from_date)
-				& (si.posting_date <= to_date)
-			)
-			.orderby(si.posting_date)
-			.orderby(si.name, order=Order.desc)
-		).run(as_dict=True)
-
-		pi = frappe.qb.DocType("Purchase Invoice")
-
-		pos_purchase_invoices = (
-			frappe.qb.from_(pi)
-			.inner_join(acc)
-			.on(pi.cash_bank_account == acc.name)
-			.select(
-				ConstantColumn("Purchase Invoice").as_("payment_document"),
-				pi.name.as_("payment_entry"),
-				pi.paid_amount.as_("credit"),
-				pi.posting_date,
-				pi.supplier.as_("against_account"),
-				pi.clearance_date,
-				acc.account_currency,
-				ConstantColumn(0).as_("debit"),
-			)
-			.where(
-				(pi.docstatus == 1)
-				& (pi.cash_bank_account == account)
-				& (pi.posting_date >= from_date)
-				& (pi.posting_date <= to_date)
-			)
-			.orderby(pi.posting_date)
-			.orderby(pi.name, order=Order.desc)
-		).run(as_dict=True)
-
-	entries = (
-		list(payment_entries) + list(journal_entries) + list(pos_sales_invoices) + list(pos_purchase_invoices)
-	)
-
-	return entries
@@ -5,8 +5,7 @@
 import csv
 import io
 import json
-import re
-from datetime import date, datetime
+from datetime import date
 
 import frappe
 import mt940
@@ -14,6 +13,7 @@ import openpyxl
 from frappe import _
 from frappe.core.doctype.data_import.data_import import DataImport
 from frappe.core.doctype.data_import.importer import Importer, ImportFile
+from frappe.utils import cint
 from frappe.utils.background_jobs import enqueue
 from frappe.utils.file_manager import get_file, save_file
 from frappe.utils.xlsxutils import ILLEGAL_CHARACTERS_RE, handle_html
@@ -21,6 +21,17 @@ from openpyxl.styles import Font
 from openpyxl.utils import get_column_letter
 
 INVALID_VALUES = ("", None)
+MT940_REQUIRED_TAGS = (":20:", ":25:", ":28C:", ":61:")
+CSV_WRITE_BUFFER_SIZE = 1 << 20  # 1 MiB
+MT940_CSV_HEADERS = (
+	"Date",
+	"Deposit",
+	"Withdrawal",
+	"Description",
+	"Reference Number",
+	"Bank Account",
+	"Currency",
+)
 
 
 class BankStatementImport(DataImport):
@@ -55,35 +66,31 @@ class BankStatementImport(DataImport):
 		super().__init__(*args, **kwargs)
 
 	def validate(self):
-		doc_before_save = self.get_doc_before_save()
-		if (
-			not (self.import_file or self.google_sheets_url)
-			or (doc_before_save and doc_before_save.import_file != self.import_file)
-			or (doc_before_save and doc_before_save.google_sheets_url != self.google_sheets_url)
-		):
-			template_options_dict = {}
-			column_to_field_map = {}
-			bank = frappe.get_doc("Bank", self.bank)
-			for i in bank.bank_transaction_mapping:
-				column_to_field_map[i.file_field] = i.bank_transaction_field
-			template_options_dict["column_to_field_map"] = column_to_field_map
-			self.template_options = json.dumps(template_options_dict)
-
+		if self.should_reset_template_options():
+			self.template_options = json.dumps({"column_to_field_map": get_column_to_field_map(self.bank)})
 			self.template_warnings = ""
 
 		if self.import_file and not self.import_file.lower().endswith(".txt"):
 			self.validate_import_file()
 			self.validate_google_sheets_url()
 
-	def start_import(self):
-		preview = frappe.get_doc("Bank Statement Import", self.name).get_preview_from_template(
-			self.import_file, self.google_sheets_url
+	def should_reset_template_options(self):
+		doc_before_save = self.get_doc_before_save()
+		if not (self.import_file or self.google_sheets_url):
+			# nothing to import yet, keep the mapping if it was already loaded from this bank
+			return not (doc_before_save and doc_before_save.bank == self.bank and self.template_options)
+
+		return bool(doc_before_save) and (
+			doc_before_save.import_file != self.import_file
+			or doc_before_save.google_sheets_url != self.google_sheets_url
 		)
 
-		if "Bank Account" not in json.dumps(preview["columns"]):
+	def start_import(self):
+		preview = self.get_preview_from_template(self.import_file, self.google_sheets_url)
+
+		if not has_bank_account_column(preview["columns"]):
 			frappe.throw(_("Please add the Bank Account column"))
 
-		from frappe.utils.background_jobs import is_job_enqueued
 		from frappe.utils.scheduler import is_scheduler_inactive
 
 		run_now = frappe.in_test or frappe.conf.developer_mode
@@ -91,26 +98,49 @@ class BankStatementImport(DataImport):
 			frappe.throw(_("Scheduler is inactive. Cannot import data."), title=_("Scheduler Inactive"))
 
 		job_id = f"bank_statement_import::{self.name}"
-		if not is_job_enqueued(job_id):
-			enqueue(
-				start_import,
-				queue="default",
-				timeout=6000,
-				event="data_import",
-				job_id=job_id,
-				data_import=self.name,
-				bank_account=self.bank_account,
-				import_file_path=self.import_file,
-				google_sheets_url=self.google_sheets_url,
-				bank=self.bank,
-				template_options=self.template_options,
-				now=run_now,
-			)
+		job = enqueue(
+			start_import,
+			queue="default",
+			timeout=6000,
+			event="data_import",
+			job_id=job_id,
+			deduplicate=True,
+			data_import=self.name,
+			bank_account=self.bank_account,
+			import_file_path=self.import_file,
+			google_sheets_url=self.google_sheets_url,
+			bank=self.bank,
+			template_options=self.template_options,
+			now=run_now,
+		)
+
+		# enqueue returns nothing when the same import is already queued or running
+		if run_now or job:
 			return job_id
 
 		return None
 
 
+def get_column_to_field_map(bank):
+	mappings = frappe.get_all(
+		"Bank Transaction Mapping",
+		filters={"parent": bank, "parenttype": "Bank"},
+		fields=["file_field", "bank_transaction_field"],
+		order_by="idx",
+	)
+	return {d.file_field: d.bank_transaction_field for d in mappings}
+
+
+def has_bank_account_column(columns) -> bool:
+	"""Check if any preview column is, or is mapped to, the Bank Account field"""
+	for column in columns:
+		df = column.get("df") or {}
+		if "Bank Account" in (column.get("header_title") or "") or df.get("label") == "Bank Account":
+			return True
+
+	return False
+
+
 def preprocess_mt940_content(content: str) -> str:
 	"""Preprocess MT940 content to fix statement number format issues.
 
@@ -122,24 +152,47 @@ def preprocess_mt940_content(content: str) -> str:
 	if ":28C:" not in content:
 		return content
 
-	# Match :28C: at start of line, capture digits and optional /seq, preserve whitespace
-	pattern = re.compile(r"(?m)^(:28C:)(\d{6,})(/\d+)?(\s*)$")
+	chunks = []
+	last = 0
+	pos = content.find(":28C:")
+	while pos != -1:
+		line_end = content.find("\n", pos)
+		if line_end == -1:
+			line_end = len(content)
+
+		# only tags at the start of a line
+		if pos == 0 or content[pos - 1] == "\n":
+			digits_start = digits_end = pos + 5
+			while digits_end < line_end and content[digits_end].isdecimal():
+				digits_end += 1
+
+			if digits_end - digits_start > 5 and is_statement_number_suffix(content[digits_end:line_end]):
+				# drop the leading digits, keeping the last 5
+				chunks.append(content[last:digits_start])
+				last = digits_end - 5
+
+		pos = content.find(":28C:", line_end)
+
+	if not chunks:
+		return content
+
+	chunks.append(content[last:])
+	return "".join(chunks)
+
 
-	def replace_statement_number(match):
-		prefix = match.group(1)  # ':28C:'
-		statement_num = match.group(2)  # The statement number
-		sequence_part = match.group(3) or ""  # The sequence part like '/1'
-		trailing_space = match.group(4) or ""  # Preserve trailing whitespace
+def is_statement_number_suffix(rest: str) -> bool:
+	"""Check if `rest` is an optional '/<sequence>' followed only by whitespace"""
+	if rest.startswith("/"):
+		sequence_end = 1
+		while sequence_end < len(rest) and rest[sequence_end].isdecimal():
+			sequence_end += 1
 
-		# If statement number is longer than 5 digits, truncate to last 5 digits
-		if len(statement_num) > 5:
-			statement_num = statement_num[-5:]
+		if sequence_end == 1:
+			return False
 
-		return prefix + statement_num + sequence_part + trailing_space
+		rest = rest[sequence_end:]
 
-	# Apply the replacement
-	processed_content = pattern.sub(replace_statement_number, content)
-	return processed_content
+	return not rest or rest.isspace()
 
 
 @frappe.whitelist()
@@ -165,27 +218,44 @@ def convert_mt940_to_csv(data_import, mt940_file_path):
 	if not transactions:
 		frappe.throw(_("Parsed file is not in valid MT940 format or contains no transactions."))
 
-	# Use in-memory file buffer instead of writing to temp file
-	csv_buffer = io.StringIO()
-	writer = csv.writer(csv_buffer)
+	# Use in-memory file buffer instead of writing to temp file,
+	# encoding as rows are written so the CSV isn't copied again for upload
+	csv_buffer = io.BytesIO()
+	csv_text = io.TextIOWrapper(csv_buffer, encoding="utf-8", newline="", write_through=True)
+	writer = csv.writer(csv_text)
+
+	writer.writerow(MT940_CSV_HEADERS)
+	writer.writerows(get_mt940_csv_rows(transactions, doc.bank_account))
+
+	# Prepare in-memory CSV for upload
+	csv_text.flush()
+	csv_content = csv_buffer.getvalue()
+	csv_text.close()
+
+	filename = f"{frappe.utils.now_datetime().strftime('%Y%m%d%H%M%S')}_converted_mt940.csv"
+
+	# Save to File Manager
+	saved_file = save_file(filename, csv_content, doc.doctype, doc.name, is_private=True, df="import_file")
+
+	return saved_file.file_url
 
-	headers = ["Date", "Deposit", "Withdrawal", "Description", "Reference Number", "Bank Account", "Currency"]
-	writer.writerow(headers)
 
+def get_mt940_csv_rows(transactions, bank_account):
+	"""Yield a CSV row for each parsed MT940 transaction"""
 	for txn in transactions:
 		txn_date = getattr(txn, "date", None)
 		raw_date = txn.data.get("date", "")
 
 		if txn_date:
 			date_str = txn_date.strftime("%Y-%m-%d")
-		elif isinstance(raw_date, date | datetime):
+		elif isinstance(raw_date, date):  # datetime is a subclass of date
 			date_str = raw_date.strftime("%Y-%m-%d")
 		else:
 			date_str = str(raw_date)
 
-		raw_amount = str(txn.data.get("amount", ""))
-		parts = raw_amount.strip().split()
-		amount_value = float(parts[0]) if parts else 0.0
+		# mt940.models.Amount, already signed for debits
+		amount = txn.data.get("amount")
+		amount_value = float(amount.amount) if amount is not None else 0.0
 
 		deposit = amount_value if amount_value > 0 else ""
 		withdrawal = abs(amount_value) if amount_value < 0 else ""
@@ -193,61 +263,51 @@ def convert_mt940_to_csv(data_import, mt940_file_path):
 		reference = txn.data.get("transaction_reference") or ""
 		currency = txn.data.get("currency", "")
 
-		writer.writerow([date_str, deposit, withdrawal, description, reference, doc.bank_account, currency])
-
-	# Prepare in-memory CSV for upload
-	csv_content = csv_buffer.getvalue().encode("utf-8")
-	csv_buffer.close()
-
-	filename = f"{frappe.utils.now_datetime().strftime('%Y%m%d%H%M%S')}_converted_mt940.csv"
-
-	# Save to File Manager
-	saved_file = save_file(filename, csv_content, doc.doctype, doc.name, is_private=True, df="import_file")
-
-	return saved_file.file_url
+		yield (date_str, deposit, withdrawal, description, reference, bank_account, currency)
 
 
 @frappe.whitelist()
 def get_preview_from_template(data_import, import_file=None, google_sheets_url=None):
-	return frappe.get_doc("Bank Statement Import", data_import).get_preview_from_template(
+	return frappe.get_cached_doc("Bank Statement Import", data_import).get_preview_from_template(
 		import_file, google_sheets_url
 	)
 
 
 @frappe.whitelist()
 def form_start_import(data_import):
-	job_id = frappe.get_doc("Bank Statement Import", data_import).start_import()
+	job_id = frappe.get_cached_doc("Bank Statement Import", data_import).start_import()
 	return job_id is not None
 
 
 @frappe.whitelist()
 def download_errored_template(data_import_name):
-	data_import = frappe.get_doc("Bank Statement Import", data_import_name)
+	data_import = frappe.get_cached_doc("Bank Statement Import", data_import_name)
 	data_import.export_errored_rows()
 
 
 @frappe.whitelist()
 def download_import_log(data_import_name):
-	return frappe.get_doc("Bank Statement Import", data_import_name).download_import_log()
+	return frappe.get_cached_doc("Bank Statement Import", data_import_name).download_import_log()
 
 
 def is_mt940_format(content: str) -> bool:
 	"""Check if the content has key MT940 tags"""
-	required_tags = [":20:", ":25:", ":28C:", ":61:"]
-	return all(tag in content for tag in required_tags)
-
-
-def parse_data_from_template(raw_data):
-	data = []
+	# tags usually appear in this order, so each search continues from the previous match
+	# and the content is scanned once; the start is only searched again for out of order tags
+	pos = 0
+	for tag in MT940_REQUIRED_TAGS:
+		found = content.find(tag, pos)
+		if found != -1:
+			pos = found + len(tag)
+		elif content.find(tag, 0, pos + len(tag) - 1) == -1:
+			return False
 
-	for _i, row in enumerate(raw_data):
-		if all(v in INVALID_VALUES for v in row):
-			# empty row
-			continue
+	return True
 
-		data.append(row)
 
-	return data
+def parse_data_from_template(raw_data):
+	# skip empty rows
+	return [row for row in raw_data if not all(v in INVALID_VALUES for v in row)]
 
 
 def start_import(data_import, bank_account, import_file_path, google_sheets_url, bank, template_options):
@@ -285,30 +345,29 @@ def start_import(data_import, bank_account, import_file_path, google_sheets_url,
 def update_mapping_db(bank, template_options):
 	"""Update bank transaction mapping database with template options."""
 	bank = frappe.get_doc("Bank", bank)
-	for d in bank.bank_transaction_mapping:
-		d.delete()
-
-	for d in json.loads(template_options)["column_to_field_map"].items():
-		bank.append("bank_transaction_mapping", {"bank_transaction_field": d[1], "file_field": d[0]})
-
+	# replacing the rows lets save() drop the old ones with a single DELETE
+	bank.set(
+		"bank_transaction_mapping",
+		[
+			{"bank_transaction_field": field, "file_field": column}
+			for column, field in json.loads(template_options)["column_to_field_map"].items()
+		],
+	)
 	bank.save()
 
 
 def add_bank_account(data, bank_account):
 	"""Add bank account information to data rows."""
-	bank_account_loc = None
 	if "Bank Account" not in data[0]:
 		data[0].append("Bank Account")
-	else:
-		for loc, header in enumerate(data[0]):
-			if header == "Bank Account":
-				bank_account_loc = loc
+		for row in data[1:]:
+			row.append(bank_account)
 
+		return
+
+	bank_account_loc = data[0].index("Bank Account")
 	for row in data[1:]:
-		if bank_account_loc:
-			row[bank_account_loc] = bank_account
-		else:
-			row.append(bank_account)
+		row[bank_account_loc] = bank_account
 
 
 def write_files(import_file, data):
@@ -319,7 +378,8 @@ def write_files(import_file, data):
 	extension = extension.lstrip(".")
 
 	if extension == "csv":
-		with open(full_file_path, "w", newline="") as file:
+		# a larger buffer so that big statements are flushed in fewer writes
+		with open(full_file_path, "w", newline="", buffering=CSV_WRITE_BUFFER_SIZE) as file:
 			writer = csv.writer(file)
 			writer.writerows(data)
 	elif extension in ("xlsx", "xls"):
@@ -342,50 +402,49 @@ def write_xlsx(data, sheet_name, wb=None, column_widths=None, file_path=None):
 	row1 = ws.row_dimensions[1]
 	row1.font = Font(name="Calibri", bold=True)
 
+	convert_html = sheet_name not in ("Data Import Template", "Data Export")
+
 	for row in data:
-		clean_row = []
-		for item in row:
-			if isinstance(item, str) and (sheet_name not in ["Data Import Template", "Data Export"]):
-				value = handle_html(item)
-			else:
-				value = item
+		ws.append([clean_xlsx_value(item, convert_html) for item in row])
 
-			if isinstance(item, str) and next(ILLEGAL_CHARACTERS_RE.finditer(value), None):
-				# Remove illegal characters from the string
-				value = re.sub(ILLEGAL_CHARACTERS_RE, "", value)
+	wb.save(file_path)
+	return True
 
-			clean_row.append(value)
 
-		ws.append(clean_row)
+def clean_xlsx_value(value, convert_html):
+	"""Make a cell value safe for openpyxl, only strings need any work."""
+	if not isinstance(value, str):
+		return value
 
-	wb.save(file_path)
-	return True
+	if convert_html:
+		value = handle_html(value)
+
+	if ILLEGAL_CHARACTERS_RE.search(value):
+		# Remove illegal characters from the string
+		value = ILLEGAL_CHARACTERS_RE.sub("", value)
+
+	return value
 
 
 @frappe.whitelist()
 def get_import_status(docname):
-	import_status = {}
-
-	data_import = frappe.get_doc("Bank Statement Import", docname)
-	import_status["status"] = data_import.status
+	import_status = {"status": frappe.db.get_value("Bank Statement Import", docname, "status")}
 
 	logs = frappe.get_all(
 		"Data Import Log",
 		fields=[{"COUNT": "*", "as": "count"}, "success"],
 		filters={"data_import": docname},
 		group_by="success",
+		as_list=True,
 	)
+	counts = {cint(success): count for count, success in logs}
 
-	total_payload_count = 0
-
-	for log in logs:
-		total_payload_count += log.get("count", 0)
-		if log.get("success"):
-			import_status["success"] = log.get("count")
-		else:
-			import_status["failed"] = log.get("count")
+	if 1 in counts:
+		import_status["success"] = counts[1]
+	if 0 in counts:
+		import_status["failed"] = counts[0]
 
-	import_status["total_records"] = total_payload_count
+	import_status["total_records"] = sum(counts.values())
 
 	return import_status
 
@@ -40,6 +40,13 @@ class TestBankStatementImport(unittest.TestCase):
 		result = preprocess_mt940_content(mt940_content)
 		self.assertEqual(result, expected_content)
 
+	def test_preprocess_mt940_content_without_long_statement_number_is_not_copied(self):
+		"""Test that content without over-long statement numbers is returned as is"""
+		mt940_content = """:20:STARTUMSE
+:28C:12345/1
+:28C:00001/2"""
+		self.assertIs(preprocess_mt940_content(mt940_content), mt940_content)
+
 	def test_preprocess_mt940_content_multiple_occurrences(self):
 		"""Test multiple statement numbers in the same content"""
 		mt940_content = """:28C:167619/1
@@ -2,18 +2,29 @@
 # For license information, please see license.txt
 
 
+from datetime import date, timedelta
+
 import frappe
 from frappe import _
 from frappe.model.document import Document
-from frappe.query_builder.functions import Sum
-from frappe.utils import add_months, flt, fmt_money, get_last_day, getdate
-from frappe.utils.data import get_first_day
+from frappe.utils import flt, fmt_money, get_last_day, getdate
 
 from erpnext.accounts.doctype.accounting_dimension.accounting_dimension import (
 	get_accounting_dimensions,
 )
 from erpnext.accounts.utils import get_fiscal_year
 
+# Above this many descendants the tree filter falls back to a correlated EXISTS
+MAX_TREE_DESCENDANTS_FOR_IN_FILTER = 1000
+
+EXPENSE_BREAKUP_TEMPLATE = (
+	"<hr> {heading} - <ul>"
+	"<li>{actual} - {actual_amount}</li>"
+	"<li>{requested} - {requested_amount}</li>"
+	"<li>{ordered} - {ordered_amount}</li>"
+	"</ul>"
+)
+
 
 class BudgetError(frappe.ValidationError):
 	pass
@@ -65,8 +76,12 @@ class Budget(Document):
 		to_fiscal_year: DF.Link
 	# end: auto-generated types
 
+	@property
+	def budget_against_field(self):
+		return frappe.scrub(self.budget_against)
+
 	def validate(self):
-		if not self.get(frappe.scrub(self.budget_against)):
+		if not self.get(self.budget_against_field):
 			frappe.throw(_("{0} is mandatory").format(self.budget_against))
 		self.validate_budget_amount()
 		self.validate_fiscal_year()
@@ -88,50 +103,49 @@ class Budget(Document):
 			self.validate_fiscal_year_company(self.to_fiscal_year, self.company)
 
 	def validate_fiscal_year_company(self, fiscal_year, company):
-		linked_companies = frappe.get_all(
-			"Fiscal Year Company", filters={"parent": fiscal_year}, pluck="company"
-		)
+		linked_companies = {d.company for d in frappe.get_cached_doc("Fiscal Year", fiscal_year).companies}
 		if linked_companies and company not in linked_companies:
 			frappe.throw(_("Fiscal Year {0} is not available for Company {1}.").format(fiscal_year, company))
 
 	def set_fiscal_year_dates(self):
 		if self.from_fiscal_year:
-			self.budget_start_date = frappe.get_cached_value(
-				"Fiscal Year", self.from_fiscal_year, "year_start_date"
-			)
+			self.budget_start_date = get_fiscal_year_dates(self.from_fiscal_year)[0]
 		if self.to_fiscal_year:
-			self.budget_end_date = frappe.get_cached_value(
-				"Fiscal Year", self.to_fiscal_year, "year_end_date"
-			)
+			self.budget_end_date = get_fiscal_year_dates(self.to_fiscal_year)[1]
 
 		if self.budget_start_date > self.budget_end_date:
 			frappe.throw(_("From Fiscal Year cannot be greater than To Fiscal Year"))
 
 	def validate_duplicate(self):
-		budget_against_field = frappe.scrub(self.budget_against)
+		budget_against_field = self.budget_against_field
 		budget_against = self.get(budget_against_field)
 		account = self.account
 
 		if not account:
 			return
 
-		existing_budget = frappe.db.sql(
-			f"""
-			SELECT name, account
-			FROM `tabBudget`
-			WHERE
-				docstatus < 2
-				AND company = %s
-				AND {budget_against_field} = %s
-				AND account = %s
-				AND name != %s
-				AND (
-					(SELECT year_start_date FROM `tabFiscal Year` WHERE name = from_fiscal_year) <= %s
-					AND (SELECT year_end_date FROM `tabFiscal Year` WHERE name = to_fiscal_year) >= %s
-				)
-			""",
-			(self.company, budget_against, account, self.name, self.budget_end_date, self.budget_start_date),
-			as_dict=True,
+		budget = frappe.qb.DocType("Budget")
+		from_fiscal_year = frappe.qb.DocType("Fiscal Year").as_("from_fiscal_year")
+		to_fiscal_year = frappe.qb.DocType("Fiscal Year").as_("to_fiscal_year")
+
+		existing_budget = (
+			frappe.qb.from_(budget)
+			.inner_join(from_fiscal_year)
+			.on(from_fiscal_year.name == budget.from_fiscal_year)
+			.inner_join(to_fiscal_year)
+			.on(to_fiscal_year.name == budget.to_fiscal_year)
+			.select(budget.name, budget.account)
+			.where(
+				(budget.docstatus < 2)
+				& (budget.company == self.company)
+				& (budget[budget_against_field] == budget_against)
+				& (budget.account == account)
+				& (budget.name != self.name)
+				& (from_fiscal_year.year_start_date <= self.budget_end_date)
+				& (to_fiscal_year.year_end_date >= self.budget_start_date)
+			)
+			.limit(1)
+			.run(as_dict=True)
 		)
 
 		if existing_budget:
@@ -190,14 +204,31 @@ class Budget(Document):
 		if self.is_new() and self.revision_of:
 			return
 
+		# spending only needs rechecking when the budget window, amount or target changed
+		old_doc = self.get_doc_before_save()
+		if old_doc and all(
+			old_doc.get(field) == self.get(field)
+			for field in (
+				"docstatus",
+				"company",
+				"account",
+				"budget_amount",
+				"budget_start_date",
+				"budget_end_date",
+				"budget_against",
+				self.budget_against_field,
+			)
+		):
+			return
+
 		params = frappe._dict(
 			{
 				"company": self.company,
 				"account": self.account,
 				"budget_start_date": self.budget_start_date,
 				"budget_end_date": self.budget_end_date,
-				"budget_against_field": frappe.scrub(self.budget_against),
-				"budget_against_doctype": frappe.unscrub(self.budget_against),
+				"budget_against_field": self.budget_against_field,
+				"budget_against_doctype": self.budget_against,
 			}
 		)
 
@@ -228,21 +259,35 @@ class Budget(Document):
 			)
 
 	def before_save(self):
+		self.flags.distribution_total_computed = False
 		self.allocate_budget()
-		self.budget_distribution_total = sum(flt(row.amount) for row in self.budget_distribution)
+		if not self.flags.distribution_total_computed:
+			self.budget_distribution_total = sum(
+				row.amount if isinstance(row.amount, int | float) else flt(row.amount)
+				for row in self.budget_distribution
+			)
 
 	def on_update(self):
 		self.validate_distribution_totals()
+		clear_budget_distribution_cache(self.name)
+
+	def on_submit(self):
+		clear_active_budget_periods_cache()
+
+	def on_cancel(self):
+		clear_active_budget_periods_cache()
 
 	def allocate_budget(self):
 		if self._should_skip_allocation():
 			return
 
-		if self._should_recalculate_manual_distribution():
+		old_doc = self.get_doc_before_save() if not self.is_new() else None
+
+		if self._should_recalculate_manual_distribution(old_doc):
 			self._recalculate_manual_distribution()
 			return
 
-		if not self.should_regenerate_budget_distribution():
+		if not self.should_regenerate_budget_distribution(old_doc):
 			return
 
 		self._regenerate_distribution()
@@ -250,32 +295,36 @@ class Budget(Document):
 	def _should_skip_allocation(self):
 		return self.revision_of and not self.distribute_equally
 
-	def _should_recalculate_manual_distribution(self):
+	def _should_recalculate_manual_distribution(self, old_doc):
 		return (
 			not self.distribute_equally
 			and bool(self.budget_distribution)
-			and self._is_only_budget_amount_changed()
+			and self._is_only_budget_amount_changed(old_doc)
 		)
 
-	def _is_only_budget_amount_changed(self):
-		old = self.get_doc_before_save()
-		if not old:
+	def _is_only_budget_amount_changed(self, old_doc):
+		if not old_doc:
 			return False
 
 		return (
-			old.budget_amount != self.budget_amount
-			and old.distribution_frequency == self.distribution_frequency
-			and old.budget_start_date == self.budget_start_date
-			and old.budget_end_date == self.budget_end_date
+			old_doc.budget_amount != self.budget_amount
+			and old_doc.distribution_frequency == self.distribution_frequency
+			and old_doc.budget_start_date == self.budget_start_date
+			and old_doc.budget_end_date == self.budget_end_date
 		)
 
 	def _recalculate_manual_distribution(self):
+		scale = flt(self.budget_amount) / 100
+		total = 0
 		for row in self.budget_distribution:
-			row.amount = flt((row.percent / 100) * self.budget_amount, 3)
+			row.amount = amount = flt(row.percent * scale, 3)
+			total += amount
+
+		self.budget_distribution_total = total
+		self.flags.distribution_total_computed = True
 
-	def should_regenerate_budget_distribution(self):
+	def should_regenerate_budget_distribution(self, old_doc):
 		"""Check whether budget distribution should be recalculated."""
-		old_doc = self.get_doc_before_save() if not self.is_new() else None
 		if not old_doc or not self.budget_distribution:
 			return True
 
@@ -309,32 +358,26 @@ class Budget(Document):
 
 	def get_budget_periods(self):
 		"""Return list of (start_date, end_date) tuples based on frequency."""
-		frequency = self.distribution_frequency
-		periods = []
-
 		start_date = getdate(self.budget_start_date)
 		end_date = getdate(self.budget_end_date)
+		if start_date > end_date:
+			return []
 
-		while start_date <= end_date:
-			period_start = get_first_day(start_date)
-			period_end = self.get_period_end(period_start, frequency)
-			period_end = min(period_end, end_date)
+		increment = self.get_month_increment(self.distribution_frequency)
+		# count months from year 0 so that period boundaries are plain integer arithmetic
+		first_month = start_date.year * 12 + start_date.month - 1
+		last_month = end_date.year * 12 + end_date.month - 1
 
-			periods.append((period_start, period_end))
-			start_date = add_months(period_start, self.get_month_increment(frequency))
+		periods = []
+		for month in range(first_month, last_month + 1, increment):
+			year, month_index = divmod(month, 12)
+			next_year, next_month_index = divmod(month + increment, 12)
 
-		return periods
+			period_start = date(year, month_index + 1, 1)
+			period_end = date(next_year, next_month_index + 1, 1) - timedelta(days=1)
+			periods.append((period_start, min(period_end, end_date)))
 
-	def get_period_end(self, start_date, frequency):
-		"""Return the correct end date for a given frequency."""
-		if frequency == "Monthly":
-			return get_last_day(start_date)
-		elif frequency == "Quarterly":
-			return get_last_day(add_months(start_date, 2))
-		elif frequency == "Half-Yearly":
-			return get_last_day(add_months(start_date, 5))
-		else:  # Yearly
-			return get_last_day(add_months(start_date, 11))
+		return periods
 
 	def get_month_increment(self, frequency):
 		"""Return how many months to move forward for the next period."""
@@ -350,7 +393,9 @@ class Budget(Document):
 		row.percent = flt(row_percent, 3)
 
 	def validate_distribution_totals(self):
-		if self.should_regenerate_budget_distribution():
+		if self.should_regenerate_budget_distribution(
+			self.get_doc_before_save() if not self.is_new() else None
+		):
 			return
 
 		total_amount = sum(d.amount for d in self.budget_distribution)
@@ -371,7 +416,8 @@ class Budget(Document):
 
 def validate_expense_against_budget(params, expense_amount=0):
 	params = frappe._dict(params)
-	if not frappe.db.count("Budget", cache=True):
+	budget_periods = get_active_budget_periods(params.company)
+	if not budget_periods:
 		return
 
 	if not params.fiscal_year:
@@ -381,20 +427,10 @@ def validate_expense_against_budget(params, expense_amount=0):
 	posting_fiscal_year = get_fiscal_year(posting_date, company=params.get("company"))[0]
 	year_start_date, year_end_date = get_fiscal_year_date_range(posting_fiscal_year, posting_fiscal_year)
 
-	budget_exists = frappe.db.sql(
-		"""
-		select name
-		from `tabBudget`
-		where company = %s
-		and docstatus = 1
-		and (SELECT year_start_date FROM `tabFiscal Year` WHERE name = from_fiscal_year) <= %s
-		and (SELECT year_end_date FROM `tabFiscal Year` WHERE name = to_fiscal_year) >= %s
-		limit 1
-		""",
-		(params.company, year_end_date, year_start_date),
-	)
-
-	if not budget_exists:
+	if not any(
+		start_date <= getdate(year_end_date) and end_date >= getdate(year_start_date)
+		for start_date, end_date in budget_periods
+	):
 		return
 
 	if params.get("company"):
@@ -425,62 +461,102 @@ def validate_expense_against_budget(params, expense_amount=0):
 		},
 	]
 
-	for dimension in default_dimensions + get_accounting_dimensions(as_list=False):
+	if frappe.get_cached_value("Account", params.account, "root_type") != "Expense":
+		return
+
+	dimensions = [
+		dimension
+		for dimension in default_dimensions + get_accounting_dimensions(as_list=False)
+		if params.get(dimension.get("fieldname"))
+	]
+	if not dimensions:
+		return
+
+	for dimension in dimensions:
 		budget_against = dimension.get("fieldname")
+		doctype = dimension.get("document_type")
 
-		if (
-			params.get(budget_against)
-			and params.account
-			and (frappe.get_cached_value("Account", params.account, "root_type") == "Expense")
-		):
-			doctype = dimension.get("document_type")
-
-			if frappe.get_cached_value("DocType", doctype, "is_tree"):
-				lft, rgt = frappe.get_cached_value(doctype, params.get(budget_against), ["lft", "rgt"])
-				condition = f"""and exists(select name from `tab{doctype}`
-					where lft<={lft} and rgt>={rgt} and name=b.{budget_against})"""  # nosec
-				params.is_tree = True
-			else:
-				condition = f"and b.{budget_against}={frappe.db.escape(params.get(budget_against))}"
-				params.is_tree = False
-
-			params.budget_against_field = budget_against
-			params.budget_against_doctype = doctype
-
-			budget_records = frappe.db.sql(
-				f"""
-				SELECT
-					b.name,
-					b.{budget_against} AS budget_against,
-					b.budget_amount,
-					b.from_fiscal_year,
-					b.to_fiscal_year,
-					b.budget_start_date,
-					b.budget_end_date,
-					IFNULL(b.applicable_on_material_request, 0) AS for_material_request,
-					IFNULL(b.applicable_on_purchase_order, 0) AS for_purchase_order,
-					IFNULL(b.applicable_on_booking_actual_expenses, 0) AS for_actual_expenses,
-					b.action_if_annual_budget_exceeded,
-					b.action_if_accumulated_monthly_budget_exceeded,
-					b.action_if_annual_budget_exceeded_on_mr,
-					b.action_if_accumulated_monthly_budget_exceeded_on_mr,
-					b.action_if_annual_budget_exceeded_on_po,
-					b.action_if_accumulated_monthly_budget_exceeded_on_po
-				FROM
-					`tabBudget` b
-				WHERE
-					b.company = %s
-					AND b.docstatus = 1
-					AND %s BETWEEN b.budget_start_date AND b.budget_end_date
-					AND b.account = %s
-					{condition}
-				""",
-				(params.company, params.posting_date, params.account),
-				as_dict=True,
-			)  # nosec
-
-			if budget_records:
-				validate_budget_records(params, budget_records, expense_amount)
+		if frappe.get_cached_value("DocType", doctype, "is_tree"):
+			lft, rgt = frappe.get_cached_value(doctype, params.get(budget_against), ["lft", "rgt"])
+			condition = f"""and exists(select name from `tab{doctype}`
+				where lft<={lft} and rgt>={rgt} and name=b.{budget_against})"""  # nosec
+			params.is_tree = True
+		else:
+			condition = f"and b.{budget_against}={frappe.db.escape(params.get(budget_against))}"
+			params.is_tree = False
+
+		params.budget_against_field = budget_against
+		params.budget_against_doctype = doctype
+
+		budget_records = frappe.db.sql(
+			f"""
+			SELECT
+				b.name,
+				b.{budget_against} AS budget_against,
+				b.budget_amount,
+				b.from_fiscal_year,
+				b.to_fiscal_year,
+				b.budget_start_date,
+				b.budget_end_date,
+				IFNULL(b.applicable_on_material_request, 0) AS for_material_request,
+				IFNULL(b.applicable_on_purchase_order, 0) AS for_purchase_order,
+				IFNULL(b.applicable_on_booking_actual_expenses, 0) AS for_actual_expenses,
+				b.action_if_annual_budget_exceeded,
+				b.action_if_accumulated_monthly_budget_exceeded,
+				b.action_if_annual_budget_exceeded_on_mr,
+				b.action_if_accumulated_monthly_budget_exceeded_on_mr,
+				b.action_if_annual_budget_exceeded_on_po,
+				b.action_if_accumulated_monthly_budget_exceeded_on_po
+			FROM
+				`tabBudget` b
+			WHERE
+				b.company = %s
+				AND b.docstatus = 1
+				AND %s BETWEEN b.budget_start_date AND b.budget_end_date
+				AND b.account = %s
+				{condition}
+			""",
+			(params.company, params.posting_date, params.account),
+			as_dict=True,
+		)  # nosec
+
+		if budget_records:
+			prefetch_budget_distribution([budget.name for budget in budget_records])
+			validate_budget_records(params, budget_records, expense_amount)
+
+
+def get_active_budget_periods(company):
+	"""Return the (start, end) dates of submitted budgets of a company, cached for the current request"""
+	if not hasattr(frappe.local, "active_budget_periods"):
+		frappe.local.active_budget_periods = {}
+
+	if company not in frappe.local.active_budget_periods:
+		budget = frappe.qb.DocType("Budget")
+		from_fiscal_year = frappe.qb.DocType("Fiscal Year").as_("from_fiscal_year")
+		to_fiscal_year = frappe.qb.DocType("Fiscal Year").as_("to_fiscal_year")
+
+		budget_periods = (
+			frappe.qb.from_(budget)
+			.inner_join(from_fiscal_year)
+			.on(from_fiscal_year.name == budget.from_fiscal_year)
+			.inner_join(to_fiscal_year)
+			.on(to_fiscal_year.name == budget.to_fiscal_year)
+			.select(from_fiscal_year.year_start_date, to_fiscal_year.year_end_date)
+			.distinct()
+			.where((budget.docstatus == 1) & (budget.company == company))
+			.run()
+		)
+
+		frappe.local.active_budget_periods[company] = {
+			(getdate(start_date), getdate(end_date)) for start_date, end_date in budget_periods
+		}
+
+	return frappe.local.active_budget_periods[company]
+
+
+def clear_active_budget_periods_cache():
+	if hasattr(frappe.local, "active_budget_periods"):
+		del frappe.local.active_budget_periods
 
 
 def validate_budget_records(params, budget_records, expense_amount):
@@ -498,6 +574,13 @@ def validate_budget_records(params, budget_records, expense_amount):
 				budget.budget_end_date,
 			)
 
+			# requested and ordered amounts do not depend on the period, so share them between checks
+			committed_amounts = None
+			if not expense_amount and (
+				yearly_action in ("Stop", "Warn") or monthly_action in ("Stop", "Warn")
+			):
+				committed_amounts = get_requested_amount(params), get_ordered_amount(params)
+
 			if yearly_action in ("Stop", "Warn"):
 				compare_expense_with_budget(
 					params,
@@ -506,6 +589,7 @@ def validate_budget_records(params, budget_records, expense_amount):
 					yearly_action,
 					budget.budget_against,
 					expense_amount,
+					committed_amounts,
 				)
 
 			if monthly_action in ["Stop", "Warn"]:
@@ -520,13 +604,16 @@ def validate_budget_records(params, budget_records, expense_amount):
 					monthly_action,
 					budget.budget_against,
 					expense_amount,
+					committed_amounts,
 				)
 
 
-def compare_expense_with_budget(params, budget_amount, action_for, action, budget_against, amount=0):
+def compare_expense_with_budget(
+	params, budget_amount, action_for, action, budget_against, amount=0, committed_amounts=None
+):
 	params.actual_expense, params.requested_amount, params.ordered_amount = get_actual_expense(params), 0, 0
 	if not amount:
-		params.requested_amount, params.ordered_amount = (
+		params.requested_amount, params.ordered_amount = committed_amounts or (
 			get_requested_amount(params),
 			get_ordered_amount(params),
 		)
@@ -557,9 +644,11 @@ def compare_expense_with_budget(params, budget_amount, action_for, action, budge
 			frappe.bold(fmt_money(diff, currency=currency)),
 		)
 
-		msg += get_expense_breakup(params, currency, budget_against)
+		msg += get_expense_breakup(
+			params, currency, budget_against, params.budget_start_date, params.budget_end_date
+		)
 
-		if frappe.flags.exception_approver_role and frappe.flags.exception_approver_role in frappe.get_roles(
+		if frappe.flags.exception_approver_role and frappe.flags.exception_approver_role in get_user_roles(
 			frappe.session.user
 		):
 			action = "Warn"
@@ -570,9 +659,13 @@ def compare_expense_with_budget(params, budget_amount, action_for, action, budge
 			frappe.msgprint(msg, indicator="orange", title=_("Budget Exceeded"))
 
 
-def get_expense_breakup(params, currency, budget_against):
-	msg = "<hr> {} - <ul>".format(_("Total Expenses booked through"))
+@frappe.request_cache
+def get_user_roles(user):
+	"""Return the roles of a user, cached for the current request"""
+	return frozenset(frappe.get_roles(user))
+
 
+def get_expense_breakup(params, currency, budget_against, from_date, to_date):
 	common_filters = frappe._dict(
 		{
 			params.budget_against_field: budget_against,
@@ -581,8 +674,6 @@ def get_expense_breakup(params, currency, budget_against):
 		}
 	)
 
-	from_date = frappe.get_cached_value("Fiscal Year", params.from_fiscal_year, "year_start_date")
-	to_date = frappe.get_cached_value("Fiscal Year", params.to_fiscal_year, "year_end_date")
 	gl_filters = common_filters.copy()
 	gl_filters.update(
 		{
@@ -592,17 +683,6 @@ def get_expense_breakup(params, currency, budget_against):
 		}
 	)
 
-	msg += (
-		"<li>"
-		+ frappe.utils.get_link_to_report(
-			"General Ledger",
-			label=_("Actual Expenses"),
-			filters=gl_filters,
-		)
-		+ " - "
-		+ frappe.bold(fmt_money(params.actual_expense, currency=currency))
-		+ "</li>"
-	)
 	mr_filters = common_filters.copy()
 	mr_filters.update(
 		{
@@ -615,20 +695,6 @@ def get_expense_breakup(params, currency, budget_against):
 		}
 	)
 
-	msg += (
-		"<li>"
-		+ frappe.utils.get_link_to_report(
-			"Material Request",
-			label=_("Material Requests"),
-			report_type="Report Builder",
-			doctype="Material Request",
-			filters=mr_filters,
-		)
-		+ " - "
-		+ frappe.bold(fmt_money(params.requested_amount, currency=currency))
-		+ "</li>"
-	)
-
 	po_filters = common_filters.copy()
 	po_filters.update(
 		{
@@ -640,22 +706,32 @@ def get_expense_breakup(params, currency, budget_against):
 		}
 	)
 
-	msg += (
-		"<li>"
-		+ frappe.utils.get_link_to_report(
+	return EXPENSE_BREAKUP_TEMPLATE.format(
+		heading=_("Total Expenses booked through"),
+		actual=frappe.utils.get_link_to_report(
+			"General Ledger",
+			label=_("Actual Expenses"),
+			filters=gl_filters,
+		),
+		actual_amount=frappe.bold(fmt_money(params.actual_expense, currency=currency)),
+		requested=frappe.utils.get_link_to_report(
+			"Material Request",
+			label=_("Material Requests"),
+			report_type="Report Builder",
+			doctype="Material Request",
+			filters=mr_filters,
+		),
+		requested_amount=frappe.bold(fmt_money(params.requested_amount, currency=currency)),
+		ordered=frappe.utils.get_link_to_report(
 			"Purchase Order",
 			label=_("Unbilled Orders"),
 			report_type="Report Builder",
 			doctype="Purchase Order",
 			filters=po_filters,
-		)
-		+ " - "
-		+ frappe.bold(fmt_money(params.ordered_amount, currency=currency))
-		+ "</li></ul>"
+		),
+		ordered_amount=frappe.bold(fmt_money(params.ordered_amount, currency=currency)),
 	)
 
-	return msg
-
 
 def get_actions(params, budget):
 	yearly_action = budget.action_if_annual_budget_exceeded
@@ -673,15 +749,14 @@ def get_actions(params, budget):
 
 
 def get_requested_amount(params):
-	item_code = params.get("item_code")
-	condition = get_other_condition(params, "Material Request")
+	condition, values = get_other_condition(params, "Material Request")
 
 	data = frappe.db.sql(
-		""" select ifnull((sum(child.stock_qty - child.ordered_qty) * rate), 0) as amount
+		f""" select ifnull((sum(child.stock_qty - child.ordered_qty) * rate), 0) as amount
 		from `tabMaterial Request Item` child, `tabMaterial Request` parent where parent.name = child.parent and
-		child.item_code = %s and parent.docstatus = 1 and child.stock_qty > child.ordered_qty and {} and
-		parent.material_request_type = 'Purchase' and parent.status != 'Stopped'""".format(condition),
-		item_code,
+		child.item_code = %(item_code)s and parent.docstatus = 1 and child.stock_qty > child.ordered_qty
+		and {condition} and parent.material_request_type = 'Purchase' and parent.status != 'Stopped'""",
+		{"item_code": params.get("item_code"), **values},
 		as_list=1,
 	)
 
@@ -689,15 +764,14 @@ def get_requested_amount(params):
 
 
 def get_ordered_amount(params):
-	item_code = params.get("item_code")
-	condition = get_other_condition(params, "Purchase Order")
+	condition, values = get_other_condition(params, "Purchase Order")
 
 	data = frappe.db.sql(
 		f""" select ifnull(sum(child.amount - child.billed_amt), 0) as amount
 		from `tabPurchase Order Item` child, `tabPurchase Order` parent where
-		parent.name = child.parent and child.item_code = %s and parent.docstatus = 1 and child.amount > child.billed_amt
-		and parent.status != 'Closed' and {condition}""",
-		item_code,
+		parent.name = child.parent and child.item_code = %(item_code)s and parent.docstatus = 1
+		and child.amount > child.billed_amt and parent.status != 'Closed' and {condition}""",
+		{"item_code": params.get("item_code"), **values},
 		as_list=1,
 	)
 
@@ -705,20 +779,28 @@ def get_ordered_amount(params):
 
 
 def get_other_condition(params, for_doc):
-	condition = f"expense_account = '{params.expense_account}'"
+	"""Return the SQL condition and its values for requested/ordered amount queries"""
+	condition = "expense_account = %(expense_account)s"
+	values = {"expense_account": params.expense_account}
 	budget_against_field = params.get("budget_against_field")
 
 	if budget_against_field and params.get(budget_against_field):
-		condition += f" and child.{budget_against_field} = '{params.get(budget_against_field)}'"
+		# the fieldname is used as an identifier, so only allow known budget dimensions
+		if budget_against_field not in ("cost_center", "project", *get_accounting_dimensions()):
+			frappe.throw(_("Invalid budget dimension {0}").format(budget_against_field))
+
+		condition += f" and child.{budget_against_field} = %(budget_against)s"
+		values["budget_against"] = params.get(budget_against_field)
 
 	date_field = "schedule_date" if for_doc == "Material Request" else "transaction_date"
 
-	start_date = frappe.get_cached_value("Fiscal Year", params.from_fiscal_year, "year_start_date")
-	end_date = frappe.get_cached_value("Fiscal Year", params.to_fiscal_year, "year_end_date")
+	values["start_date"], values["end_date"] = get_fiscal_year_date_range(
+		params.from_fiscal_year, params.to_fiscal_year
+	)
 
-	condition += f" and parent.{date_field} between '{start_date}' and '{end_date}'"
+	condition += f" and parent.{date_field} between %(start_date)s and %(end_date)s"
 
-	return condition
+	return condition, values
 
 
 def get_actual_expense(params):
@@ -728,9 +810,7 @@ def get_actual_expense(params):
 	budget_against_field = params.get("budget_against_field")
 	condition1 = " and gle.posting_date <= %(month_end_date)s" if params.get("month_end_date") else ""
 
-	date_condition = (
-		f"and gle.posting_date between '{params.budget_start_date}' and '{params.budget_end_date}'"
-	)
+	date_condition = "and gle.posting_date between %(budget_start_date)s and %(budget_end_date)s"
 
 	if params.is_tree:
 		lft_rgt = frappe.db.get_value(
@@ -738,13 +818,26 @@ def get_actual_expense(params):
 		)
 		params.update(lft_rgt)
 
-		condition2 = f"""
-			and exists(
-				select name from `tab{params.budget_against_doctype}`
-				where lft >= %(lft)s and rgt <= %(rgt)s
-				and name = gle.{budget_against_field}
-			)
-		"""
+		descendants = frappe.get_all(
+			params.budget_against_doctype,
+			filters={"lft": [">=", params.lft], "rgt": ["<=", params.rgt]},
+			pluck="name",
+			limit=MAX_TREE_DESCENDANTS_FOR_IN_FILTER + 1,
+		)
+
+		if descendants and len(descendants) <= MAX_TREE_DESCENDANTS_FOR_IN_FILTER:
+			params.budget_against_descendants = tuple(descendants)
+			condition2 = f"""
+				and gle.{budget_against_field} in %(budget_against_descendants)s
+			"""
+		else:
+			condition2 = f"""
+				and exists(
+					select name from `tab{params.budget_against_doctype}`
+					where lft >= %(lft)s and rgt <= %(rgt)s
+					and name = gle.{budget_against_field}
+				)
+			"""
 	else:
 		condition2 = f"""
 			and gle.{budget_against_field} = %({budget_against_field})s
@@ -774,20 +867,44 @@ def get_actual_expense(params):
 def get_accumulated_monthly_budget(budget_name, posting_date):
 	posting_date = getdate(posting_date)
 
-	bd = frappe.qb.DocType("Budget Distribution")
-	b = frappe.qb.DocType("Budget")
-
-	result = (
-		frappe.qb.from_(bd)
-		.join(b)
-		.on(bd.parent == b.name)
-		.select(Sum(bd.amount).as_("accumulated_amount"))
-		.where(b.name == budget_name)
-		.where(bd.start_date <= posting_date)
-		.run(as_dict=True)
+	return flt(
+		sum(
+			row.amount
+			for row in get_budget_distribution(budget_name)
+			if getdate(row.start_date) <= posting_date
+		)
 	)
 
-	return flt(result[0]["accumulated_amount"]) if result else 0.0
+
+def get_budget_distribution(budget_name):
+	"""Return the distribution rows of a budget, cached for the current request"""
+	prefetch_budget_distribution([budget_name])
+	return frappe.local.budget_distribution[budget_name]
+
+
+def prefetch_budget_distribution(budget_names):
+	"""Load the distribution rows of several budgets with a single query"""
+	if not hasattr(frappe.local, "budget_distribution"):
+		frappe.local.budget_distribution = {}
+
+	budget_names = [name for name in set(budget_names) if name not in frappe.local.budget_distribution]
+	if not budget_names:
+		return
+
+	for name in budget_names:
+		frappe.local.budget_distribution[name] = []
+
+	for row in frappe.get_all(
+		"Budget Distribution",
+		filters={"parenttype": "Budget", "parent": ["in", budget_names]},
+		fields=["parent", "start_date", "amount"],
+	):
+		frappe.local.budget_distribution[row.parent].append(row)
+
+
+def clear_budget_distribution_cache(budget_name):
+	if hasattr(frappe.local, "budget_distribution"):
+		frappe.local.budget_distribution.pop(budget_name, None)
 
 
 def get_item_details(params):
@@ -796,52 +913,46 @@ def get_item_details(params):
 	if not params.get("company"):
 		return cost_center, expense_account
 
-	if params.item_code:
-		item_defaults = frappe.db.get_value(
-			"Item Default",
-			{"parent": params.item_code, "company": params.get("company")},
-			["buying_cost_center", "expense_account"],
-		)
-		if item_defaults:
-			cost_center, expense_account = item_defaults
-
-	if not (cost_center and expense_account):
-		for doctype in ["Item Group", "Company"]:
-			data = get_expense_cost_center(doctype, params)
-
-			if not cost_center and data:
-				cost_center = data[0]
+	parents = {"Item": params.item_code, "Item Group": params.get("item_group")}
+	if any(parents.values()):
+		item_defaults = {
+			d.parenttype: d
+			for d in frappe.get_all(
+				"Item Default",
+				filters={
+					"parent": ["in", [parent for parent in parents.values() if parent]],
+					"company": params.get("company"),
+				},
+				fields=["parenttype", "parent", "buying_cost_center", "expense_account"],
+			)
+			if parents.get(d.parenttype) == d.parent
+		}
 
-			if not expense_account and data:
-				expense_account = data[1]
+		# item defaults take precedence over item group defaults
+		for parenttype in ("Item", "Item Group"):
+			if defaults := item_defaults.get(parenttype):
+				cost_center = cost_center or defaults.buying_cost_center
+				expense_account = expense_account or defaults.expense_account
 
-			if cost_center and expense_account:
-				return cost_center, expense_account
+	if not (cost_center and expense_account):
+		company_defaults = frappe.get_cached_value(
+			"Company", params.get("company"), ["cost_center", "default_expense_account"]
+		)
+		if company_defaults:
+			cost_center = cost_center or company_defaults[0]
+			expense_account = expense_account or company_defaults[1]
 
 	return cost_center, expense_account
 
 
-def get_expense_cost_center(doctype, params):
-	if doctype == "Item Group":
-		return frappe.db.get_value(
-			"Item Default",
-			{"parent": params.get(frappe.scrub(doctype)), "company": params.get("company")},
-			["buying_cost_center", "expense_account"],
-		)
-	else:
-		return frappe.db.get_value(
-			doctype, params.get(frappe.scrub(doctype)), ["cost_center", "default_expense_account"]
-		)
+def get_fiscal_year_date_range(from_fiscal_year, to_fiscal_year):
+	return get_fiscal_year_dates(from_fiscal_year)[0], get_fiscal_year_dates(to_fiscal_year)[1]
 
 
-def get_fiscal_year_date_range(from_fiscal_year, to_fiscal_year):
-	from_year = frappe.get_cached_value(
-		"Fiscal Year", from_fiscal_year, ["year_start_date", "year_end_date"], as_dict=True
-	)
-	to_year = frappe.get_cached_value(
-		"Fiscal Year", to_fiscal_year, ["year_start_date", "year_end_date"], as_dict=True
-	)
-	return from_year.year_start_date, to_year.year_end_date
+@frappe.request_cache
+def get_fiscal_year_dates(fiscal_year):
+	"""Return (year_start_date, year_end_date) of a fiscal year"""
+	return frappe.get_cached_value("Fiscal Year", fiscal_year, ["year_start_date", "year_end_date"])
 
 
 @frappe.whitelist()
@@ -857,3 +968,8 @@ def revise_budget(budget_name):
 	new_budget.insert()
 
 	return new_budget.name
+
+
+def on_doctype_update():
+	frappe.db.add_index("Budget", ["company", "docstatus", "account"])
+	frappe.db.add_index("Budget", ["company", "from_fiscal_year", "to_fiscal_year"])
@@ -1,8 +1,10 @@
 # Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
 # See license.txt
 
+from functools import lru_cache
+
 import frappe
-from frappe.utils import flt, now_datetime, nowdate
+from frappe.utils import now_datetime, nowdate
 
 from erpnext.accounts.doctype.budget.budget import (
 	BudgetError,
@@ -12,23 +14,38 @@ from erpnext.accounts.doctype.budget.budget import (
 )
 from erpnext.accounts.doctype.journal_entry.test_journal_entry import make_journal_entry
 from erpnext.accounts.utils import get_fiscal_year
-from erpnext.buying.doctype.purchase_order.test_purchase_order import create_purchase_order
 from erpnext.tests.utils import ERPNextTestSuite
 
+_ACCOUNT = "_Test Account Cost for Goods Sold - _TC"
+_CC = "_Test Cost Center - _TC"
+_BANK = "_Test Bank - _TC"
+_COMPANY = "_Test Company"
+
+# budget_against_field -> (budget_against_doctype, is_tree)
+_BUDGET_AGAINST_META = {"cost_center": ("Cost Center", True), "project": ("Project", False)}
+
 
 class TestBudget(ERPNextTestSuite):
 	@classmethod
 	def setUpClass(cls):
 		super().setUpClass()
+		if frappe.get_single_value("Accounts Settings", "use_legacy_budget_controller"):
+			frappe.db.set_single_value("Accounts Settings", "use_legacy_budget_controller", False)
+
 		cls.make_monthly_distribution()
 		cls.make_projects()
+		cls.project = frappe.db.get_value("Project", {"project_name": "_Test Project"})
+		cls.fiscal_year = frappe.db.get_value("Fiscal Year", {}, "name")
+
+	@classmethod
+	def tearDownClass(cls):
+		get_cached_fiscal_year.cache_clear()
+		super().tearDownClass()
 
 	def setUp(self):
-		frappe.db.set_single_value("Accounts Settings", "use_legacy_budget_controller", False)
-		self.company = "_Test Company"
-		self.fiscal_year = frappe.db.get_value("Fiscal Year", {}, "name")
-		self.account = "_Test Account Cost for Goods Sold - _TC"
-		self.cost_center = "_Test Cost Center - _TC"
+		self.company = _COMPANY
+		self.account = _ACCOUNT
+		self.cost_center = _CC
 
 	def test_monthly_budget_crossed_ignore(self):
 		set_total_expense_zero(nowdate(), "cost_center")
@@ -36,10 +53,10 @@ class TestBudget(ERPNextTestSuite):
 		budget = make_budget(budget_against="Cost Center", do_not_save=False, submit_budget=True)
 
 		jv = make_journal_entry(
-			"_Test Account Cost for Goods Sold - _TC",
-			"_Test Bank - _TC",
+			_ACCOUNT,
+			_BANK,
 			40000,
-			"_Test Cost Center - _TC",
+			_CC,
 			posting_date=nowdate(),
 			submit=True,
 		)
@@ -54,19 +71,22 @@ class TestBudget(ERPNextTestSuite):
 	def test_monthly_budget_crossed_stop1(self):
 		set_total_expense_zero(nowdate(), "cost_center")
 
-		budget = make_budget(budget_against="Cost Center", do_not_save=False, submit_budget=True)
-
-		frappe.db.set_value("Budget", budget.name, "action_if_accumulated_monthly_budget_exceeded", "Stop")
+		budget = make_budget(
+			budget_against="Cost Center",
+			do_not_save=False,
+			submit_budget=True,
+			action_if_accumulated_monthly_budget_exceeded="Stop",
+		)
 
 		accumulated_limit = get_accumulated_monthly_budget(
 			budget.name,
 			nowdate(),
 		)
 		jv = make_journal_entry(
-			"_Test Account Cost for Goods Sold - _TC",
-			"_Test Bank - _TC",
+			_ACCOUNT,
+			_BANK,
 			accumulated_limit + 1,
-			"_Test Cost Center - _TC",
+			_CC,
 			posting_date=nowdate(),
 		)
 
@@ -78,16 +98,19 @@ class TestBudget(ERPNextTestSuite):
 	def test_exception_approver_role(self):
 		set_total_expense_zero(nowdate(), "cost_center")
 
-		budget = make_budget(budget_against="Cost Center", do_not_save=False, submit_budget=True)
-
-		frappe.db.set_value("Budget", budget.name, "action_if_accumulated_monthly_budget_exceeded", "Stop")
+		budget = make_budget(
+			budget_against="Cost Center",
+			do_not_save=False,
+			submit_budget=True,
+			action_if_accumulated_monthly_budget_exceeded="Stop",
+		)
 
 		accumulated_limit = get_accumulated_monthly_budget(budget.name, nowdate())
 		jv = make_journal_entry(
-			"_Test Account Cost for Goods Sold - _TC",
-			"_Test Bank - _TC",
+			_ACCOUNT,
+			_BANK,
 			accumulated_limit + 1,
-			"_Test Cost Center - _TC",
+			_CC,
 			posting_date=nowdate(),
 		)
 
@@ -112,10 +135,9 @@ class TestBudget(ERPNextTestSuite):
 			budget_against="Cost Center",
 			do_not_save=False,
 			submit_budget=True,
+			action_if_accumulated_monthly_budget_exceeded="Stop",
 		)
 
-		frappe.db.set_value("Budget", budget.name, "action_if_accumulated_monthly_budget_exceeded", "Stop")
-
 		accumulated_limit = get_accumulated_monthly_budget(
 			budget.name,
 			nowdate(),
@@ -134,8 +156,8 @@ class TestBudget(ERPNextTestSuite):
 						"warehouse": "_Test Warehouse - _TC",
 						"schedule_date": nowdate(),
 						"rate": accumulated_limit + 1,
-						"expense_account": "_Test Account Cost for Goods Sold - _TC",
-						"cost_center": "_Test Cost Center - _TC",
+						"expense_account": _ACCOUNT,
+						"cost_center": _CC,
 					}
 				],
 			}
@@ -150,16 +172,17 @@ class TestBudget(ERPNextTestSuite):
 		mr.cancel()
 
 	def test_monthly_budget_crossed_for_po(self):
+		from erpnext.buying.doctype.purchase_order.test_purchase_order import create_purchase_order
+
 		budget = make_budget(
 			applicable_on_purchase_order=1,
 			action_if_accumulated_monthly_budget_exceeded_on_po="Stop",
 			budget_against="Cost Center",
 			do_not_save=False,
 			submit_budget=True,
+			action_if_accumulated_monthly_budget_exceeded="Stop",
 		)
 
-		frappe.db.set_value("Budget", budget.name, "action_if_accumulated_monthly_budget_exceeded", "Stop")
-
 		accumulated_limit = get_accumulated_monthly_budget(
 			budget.name,
 			nowdate(),
@@ -177,23 +200,26 @@ class TestBudget(ERPNextTestSuite):
 		po.cancel()
 
 	def test_monthly_budget_crossed_stop2(self):
-		set_total_expense_zero(nowdate(), "project")
+		set_total_expense_zero(nowdate(), "project", project=self.project)
 
-		budget = make_budget(budget_against="Project", do_not_save=False, submit_budget=True)
-
-		frappe.db.set_value("Budget", budget.name, "action_if_accumulated_monthly_budget_exceeded", "Stop")
+		budget = make_budget(
+			budget_against="Project",
+			project=self.project,
+			do_not_save=False,
+			submit_budget=True,
+			action_if_accumulated_monthly_budget_exceeded="Stop",
+		)
 
-		project = frappe.get_value("Project", {"project_name": "_Test Project"})
 		accumulated_limit = get_accumulated_monthly_budget(
 			budget.name,
 			nowdate(),
 		)
 		jv = make_journal_entry(
-			"_Test Account Cost for Goods Sold - _TC",
-			"_Test Bank - _TC",
+			_ACCOUNT,
+			_BANK,
 			accumulated_limit + 1,
-			"_Test Cost Center - _TC",
-			project=project,
+			_CC,
+			project=self.project,
 			posting_date=nowdate(),
 		)
 
@@ -208,10 +234,10 @@ class TestBudget(ERPNextTestSuite):
 		budget = make_budget(budget_against="Cost Center", do_not_save=False, submit_budget=True)
 
 		jv = make_journal_entry(
-			"_Test Account Cost for Goods Sold - _TC",
-			"_Test Bank - _TC",
+			_ACCOUNT,
+			_BANK,
 			250000,
-			"_Test Cost Center - _TC",
+			_CC,
 			posting_date=nowdate(),
 		)
 
@@ -220,18 +246,18 @@ class TestBudget(ERPNextTestSuite):
 		budget.cancel()
 
 	def test_yearly_budget_crossed_stop2(self):
-		set_total_expense_zero(nowdate(), "project")
-
-		budget = make_budget(budget_against="Project", do_not_save=False, submit_budget=True)
+		set_total_expense_zero(nowdate(), "project", project=self.project)
 
-		project = frappe.get_value("Project", {"project_name": "_Test Project"})
+		budget = make_budget(
+			budget_against="Project", project=self.project, do_not_save=False, submit_budget=True
+		)
 
 		jv = make_journal_entry(
-			"_Test Account Cost for Goods Sold - _TC",
-			"_Test Bank - _TC",
+			_ACCOUNT,
+			_BANK,
 			250000,
-			"_Test Cost Center - _TC",
-			project=project,
+			_CC,
+			project=self.project,
 			posting_date=nowdate(),
 		)
 
@@ -247,12 +273,13 @@ class TestBudget(ERPNextTestSuite):
 		if month > 9:
 			month = 9
 
-		for _i in range(month + 1):
+		# book the expense of the earlier months in one entry and the current month in another
+		for amount in (20000 * month, 20000):
 			jv = make_journal_entry(
-				"_Test Account Cost for Goods Sold - _TC",
-				"_Test Bank - _TC",
-				20000,
-				"_Test Cost Center - _TC",
+				_ACCOUNT,
+				_BANK,
+				amount,
+				_CC,
 				posting_date=nowdate(),
 				submit=True,
 			)
@@ -269,23 +296,25 @@ class TestBudget(ERPNextTestSuite):
 		budget.cancel()
 
 	def test_monthly_budget_on_cancellation2(self):
-		set_total_expense_zero(nowdate(), "project")
+		set_total_expense_zero(nowdate(), "project", project=self.project)
 
-		budget = make_budget(budget_against="Project", do_not_save=False, submit_budget=True)
+		budget = make_budget(
+			budget_against="Project", project=self.project, do_not_save=False, submit_budget=True
+		)
 		month = now_datetime().month
 		if month > 9:
 			month = 9
 
-		project = frappe.get_value("Project", {"project_name": "_Test Project"})
-		for _i in range(month + 1):
+		# book the expense of the earlier months in one entry and the current month in another
+		for amount in (20000 * month, 20000):
 			jv = make_journal_entry(
-				"_Test Account Cost for Goods Sold - _TC",
-				"_Test Bank - _TC",
-				20000,
-				"_Test Cost Center - _TC",
+				_ACCOUNT,
+				_BANK,
+				amount,
+				_CC,
 				posting_date=nowdate(),
 				submit=True,
-				project=project,
+				project=self.project,
 			)
 
 			self.assertTrue(
@@ -308,16 +337,16 @@ class TestBudget(ERPNextTestSuite):
 			cost_center="_Test Company - _TC",
 			do_not_save=False,
 			submit_budget=True,
+			action_if_accumulated_monthly_budget_exceeded="Stop",
 		)
-		frappe.db.set_value("Budget", budget.name, "action_if_accumulated_monthly_budget_exceeded", "Stop")
 
 		accumulated_limit = get_accumulated_monthly_budget(
 			budget.name,
 			nowdate(),
 		)
 		jv = make_journal_entry(
-			"_Test Account Cost for Goods Sold - _TC",
-			"_Test Bank - _TC",
+			_ACCOUNT,
+			_BANK,
 			accumulated_limit + 1,
 			"_Test Cost Center 2 - _TC",
 			posting_date=nowdate(),
@@ -337,23 +366,26 @@ class TestBudget(ERPNextTestSuite):
 					"doctype": "Cost Center",
 					"cost_center_name": "_Test Cost Center 3",
 					"parent_cost_center": "_Test Company - _TC",
-					"company": "_Test Company",
+					"company": _COMPANY,
 					"is_group": 0,
 				}
 			).insert(ignore_permissions=True)
 
 		budget = make_budget(
-			budget_against="Cost Center", cost_center=cost_center, do_not_save=False, submit_budget=True
+			budget_against="Cost Center",
+			cost_center=cost_center,
+			do_not_save=False,
+			submit_budget=True,
+			action_if_accumulated_monthly_budget_exceeded="Stop",
 		)
-		frappe.db.set_value("Budget", budget.name, "action_if_accumulated_monthly_budget_exceeded", "Stop")
 
 		accumulated_limit = get_accumulated_monthly_budget(
 			budget.name,
 			nowdate(),
 		)
 		jv = make_journal_entry(
-			"_Test Account Cost for Goods Sold - _TC",
-			"_Test Bank - _TC",
+			_ACCOUNT,
+			_BANK,
 			accumulated_limit + 1,
 			cost_center,
 			posting_date=nowdate(),
@@ -378,10 +410,10 @@ class TestBudget(ERPNextTestSuite):
 		]
 
 		for cc in cost_centers:
-			create_cost_center(cost_center_name=cc, company="_Test Company")
+			create_cost_center(cost_center_name=cc, company=_COMPANY)
 
 		create_cost_center_allocation(
-			"_Test Company",
+			_COMPANY,
 			"Main Budget Cost Center 1 - _TC",
 			{"Sub Budget Cost Center 1 - _TC": 60, "Sub Budget Cost Center 2 - _TC": 40},
 		)
@@ -394,8 +426,8 @@ class TestBudget(ERPNextTestSuite):
 		)
 
 		jv = make_journal_entry(
-			"_Test Account Cost for Goods Sold - _TC",
-			"_Test Bank - _TC",
+			_ACCOUNT,
+			_BANK,
 			400000,
 			"Main Budget Cost Center 1 - _TC",
 			posting_date=nowdate(),
@@ -404,6 +436,8 @@ class TestBudget(ERPNextTestSuite):
 		self.assertRaises(BudgetError, jv.submit)
 
 	def test_action_for_cumulative_limit(self):
+		from erpnext.buying.doctype.purchase_order.test_purchase_order import create_purchase_order
+
 		set_total_expense_zero(nowdate(), "cost_center")
 
 		budget = make_budget(
@@ -416,10 +450,10 @@ class TestBudget(ERPNextTestSuite):
 		accumulated_limit = get_accumulated_monthly_budget(budget.name, nowdate())
 
 		jv = make_journal_entry(
-			"_Test Account Cost for Goods Sold - _TC",
-			"_Test Bank - _TC",
+			_ACCOUNT,
+			_BANK,
 			accumulated_limit - 1,
-			"_Test Cost Center - _TC",
+			_CC,
 			posting_date=nowdate(),
 		)
 		jv.submit()
@@ -451,7 +485,7 @@ class TestBudget(ERPNextTestSuite):
 				"year": "2100",
 				"year_start_date": "2100-04-01",
 				"year_end_date": "2101-03-31",
-				"companies": [{"company": "_Test Company"}],
+				"companies": [{"company": _COMPANY}],
 			}
 		).insert(ignore_permissions=True)
 
@@ -487,8 +521,8 @@ class TestBudget(ERPNextTestSuite):
 			budget_against="Cost Center", budget_amount=120000, do_not_save=False, submit_budget=True
 		)
 
-		total = sum([d.amount for d in budget.budget_distribution])
-		self.assertEqual(flt(total), 120000)
+		total = sum(d.amount for d in budget.budget_distribution)
+		self.assertEqual(total, 120000)
 		self.assertTrue(all(d.amount == 10000 for d in budget.budget_distribution))
 
 	def test_create_revised_budget(self):
@@ -507,7 +541,7 @@ class TestBudget(ERPNextTestSuite):
 		self.assertEqual(old_budget.docstatus, 2)
 
 	def test_revision_preserves_distribution(self):
-		set_total_expense_zero(nowdate(), "cost_center", "_Test Cost Center - _TC")
+		set_total_expense_zero(nowdate(), "cost_center", _CC)
 		budget = make_budget(
 			budget_against="Cost Center", budget_amount=120000, do_not_save=False, submit_budget=True
 		)
@@ -561,7 +595,7 @@ class TestBudget(ERPNextTestSuite):
 
 		budget.from_fiscal_year = fy.name
 		budget.to_fiscal_year = fy.name
-		budget.company = "_Test Company"
+		budget.company = _COMPANY
 
 		with self.assertRaises(frappe.ValidationError):
 			budget.save()
@@ -569,7 +603,7 @@ class TestBudget(ERPNextTestSuite):
 	def test_manual_distribution_total_equals_budget_amount(self):
 		budget = make_budget(
 			budget_against="Cost Center",
-			cost_center="_Test Cost Center - _TC",
+			cost_center=_CC,
 			distribute_equally=0,
 			budget_amount=12000,
 			do_not_save=False,
@@ -592,33 +626,37 @@ class TestBudget(ERPNextTestSuite):
 		)
 
 		new_budget = frappe.new_doc("Budget")
-		new_budget.company = "_Test Company"
+		new_budget.company = _COMPANY
 		new_budget.from_fiscal_year = budget.from_fiscal_year
 		new_budget.to_fiscal_year = new_budget.from_fiscal_year
 		new_budget.budget_against = "Cost Center"
-		new_budget.cost_center = "_Test Cost Center - _TC"
-		new_budget.account = "_Test Account Cost for Goods Sold - _TC"
+		new_budget.cost_center = _CC
+		new_budget.account = _ACCOUNT
 		new_budget.budget_amount = 10000
 
 		with self.assertRaises(frappe.ValidationError):
 			new_budget.insert()
 
 
-def set_total_expense_zero(posting_date, budget_against_field=None, budget_against_CC=None):
+@lru_cache(maxsize=8)
+def get_cached_fiscal_year(date):
+	return get_fiscal_year(date)
+
+
+def set_total_expense_zero(posting_date, budget_against_field=None, budget_against_CC=None, project=None):
 	if budget_against_field == "project":
-		budget_against = frappe.db.get_value("Project", {"project_name": "_Test Project"})
+		budget_against = project or frappe.db.get_value("Project", {"project_name": "_Test Project"})
 	else:
-		budget_against = budget_against_CC or "_Test Cost Center - _TC"
+		budget_against = budget_against_CC or _CC
 
-	fiscal_year = get_fiscal_year(nowdate())[0]
-	fiscal_year_start_date, fiscal_year_end_date = get_fiscal_year(nowdate())[1:3]
+	fiscal_year, fiscal_year_start_date, fiscal_year_end_date = get_cached_fiscal_year(nowdate())[:3]
 
 	args = frappe._dict(
 		{
-			"account": "_Test Account Cost for Goods Sold - _TC",
-			"cost_center": "_Test Cost Center - _TC",
+			"account": _ACCOUNT,
+			"cost_center": _CC,
 			"month_end_date": posting_date,
-			"company": "_Test Company",
+			"company": _COMPANY,
 			"from_fiscal_year": fiscal_year,
 			"to_fiscal_year": fiscal_year,
 			"budget_against_field": budget_against_field,
@@ -630,31 +668,26 @@ def set_total_expense_zero(posting_date, budget_against_field=None, budget_again
 	if not args.get(budget_against_field):
 		args[budget_against_field] = budget_against
 
-	args.budget_against_doctype = frappe.unscrub(budget_against_field)
-
-	if frappe.get_cached_value("DocType", args.budget_against_doctype, "is_tree"):
-		args.is_tree = True
-	else:
-		args.is_tree = False
+	args.budget_against_doctype, args.is_tree = _BUDGET_AGAINST_META[budget_against_field]
 
 	existing_expense = get_actual_expense(args)
 
 	if existing_expense:
 		if budget_against_field == "cost_center":
 			make_journal_entry(
-				"_Test Account Cost for Goods Sold - _TC",
-				"_Test Bank - _TC",
+				_ACCOUNT,
+				_BANK,
 				-existing_expense,
-				"_Test Cost Center - _TC",
+				_CC,
 				posting_date=nowdate(),
 				submit=True,
 			)
 		elif budget_against_field == "project":
 			make_journal_entry(
-				"_Test Account Cost for Goods Sold - _TC",
-				"_Test Bank - _TC",
+				_ACCOUNT,
+				_BANK,
 				-existing_expense,
-				"_Test Cost Center - _TC",
+				_CC,
 				submit=True,
 				project=budget_against,
 				posting_date=nowdate(),
@@ -666,49 +699,53 @@ def make_budget(**args):
 
 	budget_against = args.budget_against
 	cost_center = args.cost_center
-	fiscal_year = get_fiscal_year(nowdate())[0]
+	fiscal_year = get_cached_fiscal_year(nowdate())[0]
 
 	if budget_against == "Project":
-		project = frappe.get_value("Project", {"project_name": "_Test Project"})
+		project = args.project or frappe.get_value("Project", {"project_name": "_Test Project"})
 		budget_list = frappe.get_all(
 			"Budget",
 			filters={
 				"project": project,
-				"account": "_Test Account Cost for Goods Sold - _TC",
+				"account": _ACCOUNT,
 			},
-			pluck="name",
+			fields=["name", "docstatus"],
 		)
 	else:
 		budget_list = frappe.get_all(
 			"Budget",
 			filters={
-				"cost_center": cost_center or "_Test Cost Center - _TC",
-				"account": "_Test Account Cost for Goods Sold - _TC",
+				"cost_center": cost_center or _CC,
+				"account": _ACCOUNT,
 			},
-			pluck="name",
+			fields=["name", "docstatus"],
 		)
 
-	for name in budget_list:
-		doc = frappe.get_doc("Budget", name)
-		if doc.docstatus == 1:
-			doc.cancel()
-		frappe.delete_doc("Budget", name, force=True, ignore_missing=True)
+	for d in budget_list:
+		if d.docstatus == 1:
+			frappe.get_doc("Budget", d.name).cancel()
+
+	if budget_names := [d.name for d in budget_list]:
+		frappe.db.delete("Budget Distribution", {"parenttype": "Budget", "parent": ("in", budget_names)})
+		frappe.db.delete("Budget", {"name": ("in", budget_names)})
 
 	budget = frappe.new_doc("Budget")
 
 	if budget_against == "Project":
-		budget.project = frappe.get_value("Project", {"project_name": "_Test Project"})
+		budget.project = project
 	else:
-		budget.cost_center = cost_center or "_Test Cost Center - _TC"
+		budget.cost_center = cost_center or _CC
 
 	budget.from_fiscal_year = args.from_fiscal_year or fiscal_year
 	budget.to_fiscal_year = args.to_fiscal_year or fiscal_year
-	budget.company = "_Test Company"
-	budget.account = "_Test Account Cost for Goods Sold - _TC"
+	budget.company = _COMPANY
+	budget.account = _ACCOUNT
 	budget.budget_amount = args.budget_amount or 200000
 	budget.applicable_on_booking_actual_expenses = 1
 	budget.action_if_annual_budget_exceeded = "Stop"
-	budget.action_if_accumulated_monthly_budget_exceeded = "Ignore"
+	budget.action_if_accumulated_monthly_budget_exceeded = (
+		args.action_if_accumulated_monthly_budget_exceeded or "Ignore"
+	)
 	budget.budget_against = budget_against
 
 	budget.distribution_frequency = "Monthly"
@@ -40,8 +40,12 @@ class FinancialReportTemplate(Document):
 		self._export_template()
 
 	def on_trash(self):
+		_account_category_cache.pop(self.name, None)
 		self._delete_template()
 
+	def after_rename(self, old_name, new_name, merge=False):
+		_account_category_cache.pop(old_name, None)
+
 	def _export_template(self):
 		from frappe.modules.utils import export_module_json
 
@@ -57,6 +61,8 @@ class FinancialReportTemplate(Document):
 
 		module_path = frappe.get_module_path(self.module)
 		dir_path = os.path.join(module_path, "financial_report_template", frappe.scrub(self.name))
+		if not os.path.isdir(dir_path):
+			return
 
 		shutil.rmtree(dir_path, ignore_errors=True)
 
@@ -70,12 +76,19 @@ class FinancialReportTemplate(Document):
 		if not self.module or not frappe.conf.developer_mode or frappe.flags.in_import:
 			return
 
-		# Extract category from rows
-		extractor = FormulaFieldExtractor(
-			field_name="account_category", exclude_operators=["like", "not like"]
-		)
+		# Extract category from rows, reusing the last result if the formulas are unchanged
 		account_data_rows = [row for row in self.rows if row.data_source == "Account Data"]
-		category_names = extractor.extract_from_rows(account_data_rows)
+		signature = tuple(row.calculation_formula for row in account_data_rows)
+		cached = _account_category_cache.get(self.name)
+
+		if cached and cached[0] == signature:
+			category_names = cached[1]
+		else:
+			extractor = FormulaFieldExtractor(
+				field_name="account_category", exclude_operators=["like", "not like"]
+			)
+			category_names = extractor.extract_from_rows(account_data_rows)
+			_account_category_cache[self.name] = (signature, category_names)
 
 		if not category_names:
 			return
@@ -85,33 +98,68 @@ class FinancialReportTemplate(Document):
 		categories_file = os.path.join(module_path, "financial_report_template", "account_categories.json")
 
 		# Load existing categories
-		existing_categories = {}
-		if os.path.exists(categories_file):
-			try:
-				with open(categories_file) as f:
-					existing_data = json.load(f)
-					existing_categories = {cat["account_category_name"]: cat for cat in existing_data}
-			except (json.JSONDecodeError, KeyError):
-				pass  # Create new file
-
-		# Fetch categories from database
-		if category_names:
-			db_categories = frappe.get_all(
-				"Account Category",
-				filters={"account_category_name": ["in", list(category_names)]},
-				fields=["account_category_name", "description"],
-			)
+		existing_categories = _load_exported_categories(categories_file)
 
-			for cat in db_categories:
-				existing_categories[cat["account_category_name"]] = cat
+		# Nothing to export if every category is already on disk
+		missing_categories = category_names - existing_categories.keys()
+		if not missing_categories:
+			return
+
+		# Fetch missing categories from database
+		db_categories = frappe.get_all(
+			"Account Category",
+			filters={"account_category_name": ["in", list(missing_categories)]},
+			fields=["account_category_name", "description"],
+		)
+
+		for cat in db_categories:
+			existing_categories[cat["account_category_name"]] = cat
 
 		# Sort by category name
 		sorted_categories = sorted(existing_categories.values(), key=lambda x: x["account_category_name"])
 
-		# Write to file
+		# Write to a temporary file and swap it in, so a crash never leaves a partial file
 		os.makedirs(os.path.dirname(categories_file), exist_ok=True)
-		with open(categories_file, "w") as f:
-			json.dump(sorted_categories, f, indent=2)
+		temp_file = f"{categories_file}.tmp"
+		with open(temp_file, "w") as f:
+			f.write(json.dumps(sorted_categories, indent=2))
+
+		os.replace(temp_file, categories_file)
+		_exported_categories_cache[categories_file] = (
+			os.stat(categories_file).st_mtime_ns,
+			{cat["account_category_name"]: cat for cat in sorted_categories},
+		)
+
+
+# template name -> (account data formulas, extracted account categories)
+_account_category_cache: dict[str, tuple[tuple, set]] = {}
+
+# categories file path -> (mtime in ns, categories by name)
+_exported_categories_cache: dict[str, tuple[int, dict]] = {}
+
+
+def _load_exported_categories(categories_file):
+	"""Return the categories in an exported categories file, reparsing only when it changed"""
+	import json
+
+	try:
+		mtime = os.stat(categories_file).st_mtime_ns
+	except FileNotFoundError:
+		return {}
+
+	cached = _exported_categories_cache.get(categories_file)
+	if cached and cached[0] == mtime:
+		return cached[1].copy()
+
+	categories = {}
+	try:
+		with open(categories_file) as f:
+			categories = {cat["account_category_name"]: cat for cat in json.load(f)}
+	except (json.JSONDecodeError, KeyError):
+		pass  # Create new file
+
+	_exported_categories_cache[categories_file] = (mtime, categories)
+	return categories.copy()
 
 
 def sync_financial_report_templates(chart_of_accounts=None, existing_company=None):
@@ -141,6 +189,10 @@ def sync_financial_report_templates(chart_of_accounts=None, existing_company=Non
 
 def _sync_templates_for(app_name):
 	templates = []
+	# template folders are named after the scrubbed template name
+	existing_templates = {
+		frappe.scrub(name) for name in frappe.get_all("Financial Report Template", pluck="name")
+	}
 
 	for module_name in frappe.local.app_modules.get(app_name) or []:
 		module_path = frappe.get_module_path(module_name)
@@ -151,10 +203,14 @@ def _sync_templates_for(app_name):
 
 		import_account_categories(template_path)
 
-		for template_dir in os.listdir(template_path):
-			json_file = os.path.join(template_path, template_dir, f"{template_dir}.json")
-			if os.path.isfile(json_file):
-				templates.append(json_file)
+		with os.scandir(template_path) as entries:
+			for entry in entries:
+				if not entry.is_dir() or entry.name in existing_templates:
+					continue
+
+				json_file = os.path.join(entry.path, f"{entry.name}.json")
+				if os.path.isfile(json_file):
+					templates.append(json_file)
 
 	if not templates:
 		return
@@ -166,13 +222,14 @@ def _sync_templates_for(app_name):
 		with open(template_path) as f:
 			template_data = frappe._dict(frappe.parse_json(f.read()))
 
-		template_name = template_data.get("name")
+		template_name = frappe.scrub(template_data.get("name"))
 
-		if not frappe.db.exists("Financial Report Template", template_name):
+		if template_name not in existing_templates:
 			doc = frappe.get_doc(template_data)
 			doc.flags.ignore_mandatory = True
 			doc.flags.ignore_permissions = True
 			doc.flags.ignore_validate = True
 			doc.insert()
+			existing_templates.add(template_name)
 
 	frappe.flags.in_import = False
@@ -2,15 +2,37 @@
 # For license information, please see license.txt
 
 import json
+import keyword
 import re
 from abc import ABC, abstractmethod
+from collections.abc import Iterable
 from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
+from types import MappingProxyType
 from typing import Any
 
 import frappe
 from frappe import _
 from frappe.database.operator_map import OPERATOR_MAP
 
+REFERENCE_CODE_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9_-]*$")
+WORD_PATTERN = re.compile(r"\w+")
+NUMBER_PATTERN = r"(?:\d+\.\d+|[1-9]\d*|0)"
+LIST_VALUE_OPERATORS = frozenset(("in", "not in"))
+LOGICAL_OPERATORS = frozenset(("and", "or"))
+
+FORMULA_FUNCTIONS = {
+	"abs": abs,
+	"round": round,
+	"min": min,
+	"max": max,
+	"sum": sum,
+	"sqrt": lambda x: x**0.5,
+	"pow": pow,
+	"ceil": lambda x: int(x) + (1 if x % 1 else 0),
+	"floor": lambda x: int(x),
+}
+
 
 @dataclass
 class ValidationIssue:
@@ -26,10 +48,13 @@ class ValidationIssue:
 			self.details = {}
 
 	def __str__(self) -> str:
-		prefix = f"Row {self.row_idx}: " if self.row_idx else ""
-		field_info = f"[{self.field}] " if self.field else ""
-		message = f"{prefix}{field_info}{self.message}"
-		return _(message)
+		# Untranslated, so messages that are only logged or never shown skip translation
+		message = self.message
+		if self.field:
+			message = f"[{self.field}] {message}"
+		if self.row_idx:
+			message = f"Row {self.row_idx}: {message}"
+		return message
 
 
 @dataclass
@@ -67,8 +92,8 @@ class ValidationResult:
 		self.warnings.append(issue)
 
 	def notify_user(self) -> None:
-		warnings = "<br><br>".join(str(w) for w in self.warnings)
-		errors = "<br><br>".join(str(e) for e in self.issues)
+		warnings = "<br><br>".join(_(str(w)) for w in self.warnings)
+		errors = "<br><br>".join(_(str(e)) for e in self.issues)
 
 		if warnings:
 			frappe.msgprint(warnings, title=_("Warnings"), indicator="orange")
@@ -86,32 +111,33 @@ class TemplateValidator:
 			TemplateStructureValidator(),
 			DependencyValidator(template),
 		]
-		self.formula_validator = FormulaValidator(template)
+		self.formula_validator = FormulaValidator(template, get_account_fields())
 
 	def validate(self) -> ValidationResult:
 		result = ValidationResult([])
 
 		# Run template-level validators
 		for validator in self.validators:
-			result.merge(validator.validate(self.template))
+			validator.validate(self.template, result)
 
 		# Run row-level validations
-		account_fields = {field.fieldname for field in frappe.get_meta("Account").fields}
 		for row in self.template.rows:
-			result.merge(self.formula_validator.validate(row, account_fields))
+			self.formula_validator.validate(row, result)
 
 		return result
 
 
 class Validator(ABC):
 	@abstractmethod
-	def validate(self, context: Any) -> ValidationResult:
+	def validate(self, context: Any, result: ValidationResult | None = None) -> ValidationResult:
+		"""Validate `context`, adding issues to `result` (a new one if not passed) and returning it"""
 		pass
 
 
 class TemplateStructureValidator(Validator):
-	def validate(self, template) -> ValidationResult:
-		result = ValidationResult()
+	def validate(self, template, result: ValidationResult | None = None) -> ValidationResult:
+		if result is None:
+			result = ValidationResult()
 
 		result.merge(self._validate_reference_codes(template))
 		result.merge(self._validate_required_fields(template))
@@ -129,7 +155,7 @@ class TemplateStructureValidator(Validator):
 			ref_code = row.reference_code.strip()
 
 			# Check format
-			if not re.match(r"^[A-Za-z][A-Za-z0-9_-]*$", ref_code):
+			if not REFERENCE_CODE_PATTERN.match(ref_code):
 				result.add_error(
 					ValidationIssue(
 						message=f"Invalid line reference format: '{ref_code}'. Must start with letter and contain only letters, numbers, underscores, and hyphens",
@@ -178,10 +204,17 @@ class TemplateStructureValidator(Validator):
 class DependencyValidator(Validator):
 	def __init__(self, template):
 		self.template = template
+		# first row index of every reference code, also the set of available codes
+		self._row_idx_by_code = {}
+		for row in template.rows:
+			if row.reference_code:
+				self._row_idx_by_code.setdefault(row.reference_code, row.idx)
+
 		self.dependencies = self._build_dependency_graph()
 
-	def validate(self, context=None) -> ValidationResult:
-		result = ValidationResult()
+	def validate(self, context=None, result: ValidationResult | None = None) -> ValidationResult:
+		if result is None:
+			result = ValidationResult()
 
 		result.merge(self._validate_circular_dependencies())
 		result.merge(self._validate_missing_dependencies())
@@ -190,11 +223,11 @@ class DependencyValidator(Validator):
 
 	def _build_dependency_graph(self) -> dict[str, list[str]]:
 		graph = {}
-		available_codes = {row.reference_code for row in self.template.rows if row.reference_code}
+		available_codes = self._row_idx_by_code.keys()
 
 		for row in self.template.rows:
 			if row.reference_code and row.data_source == "Calculated Amount" and row.calculation_formula:
-				deps = extract_reference_codes_from_formula(row.calculation_formula, list(available_codes))
+				deps = extract_reference_codes_from_formula(row.calculation_formula, available_codes)
 				if deps:
 					graph[row.reference_code] = deps
 
@@ -204,9 +237,12 @@ class DependencyValidator(Validator):
 		"""
 		Efficient cycle detection using DFS (Depth-First Search) with three-color algorithm:
 		- WHITE (0): unvisited node
-		- GRAY (1): currently being processed (on recursion stack)
+		- GRAY (1): currently being processed (on the current path)
 		- BLACK (2): fully processed
 
+		The traversal keeps an explicit stack of neighbour iterators instead of recursing,
+		so deep dependency chains cannot hit the recursion limit.
+
 		Example cycle detection:
 		A → B → C → A (cycle detected when A is GRAY and visited again)
 		"""
@@ -214,40 +250,45 @@ class DependencyValidator(Validator):
 		WHITE, GRAY, BLACK = 0, 1, 2
 		colors = {node: WHITE for node in self.dependencies}
 
-		def dfs(node, path):
-			if node not in colors:
-				return  # External dependency
+		for start in self.dependencies:
+			if colors[start] != WHITE:
+				continue
 
-			if colors[node] == GRAY:
-				# Found cycle
-				cycle_start = path.index(node)
-				cycle = [*path[cycle_start:], node]
-				result.add_error(
-					ValidationIssue(
-						message=f"Circular dependency detected: {' → '.join(cycle)}",
-					)
-				)
-				return
+			colors[start] = GRAY
+			path = [start]
+			stack = [iter(self.dependencies[start])]
 
-			if colors[node] == BLACK:
-				return  # Already processed
+			while stack:
+				neighbor = next(stack[-1], None)
 
-			colors[node] = GRAY
-			path.append(node)
+				if neighbor is None:
+					# All neighbours processed
+					colors[path.pop()] = BLACK
+					stack.pop()
+					continue
 
-			for neighbor in self.dependencies.get(node, []):
-				dfs(neighbor, path.copy())
+				color = colors.get(neighbor)
+				if color is None or color == BLACK:
+					continue  # External dependency or already processed
 
-			colors[node] = BLACK
+				if color == GRAY:
+					# Found cycle
+					cycle = [*path[path.index(neighbor) :], neighbor]
+					result.add_error(
+						ValidationIssue(
+							message=f"Circular dependency detected: {' → '.join(cycle)}",
+						)
+					)
+					continue
 
-		for node in self.dependencies:
-			if colors[node] == WHITE:
-				dfs(node, [])
+				colors[neighbor] = GRAY
+				path.append(neighbor)
+				stack.append(iter(self.dependencies.get(neighbor, [])))
 
 		return result
 
 	def _validate_missing_dependencies(self) -> ValidationResult:
-		available = {row.reference_code for row in self.template.rows if row.reference_code}
+		available = self._row_idx_by_code
 		result = ValidationResult()
 
 		for ref_code, deps in self.dependencies.items():
@@ -264,21 +305,24 @@ class DependencyValidator(Validator):
 		return result
 
 	def _get_row_idx(self, reference_code: str) -> int | None:
-		for row in self.template.rows:
-			if row.reference_code == reference_code:
-				return row.idx
-		return None
+		return self._row_idx_by_code.get(reference_code)
 
 
 class CalculationFormulaValidator(Validator):
 	"""Validates calculation formulas used in Calculated Amount rows"""
 
-	def __init__(self, reference_codes: set[str]):
+	def __init__(self, reference_codes: set[str], match_simple_formulas: bool = False):
 		self.reference_codes = reference_codes
+		# Only worth it when many rows are validated against the same codes,
+		# the pattern is an alternation of all of them and slow to compile
+		self.match_simple_formulas = match_simple_formulas
+		# dummy values for every code, shared read-only by all rows' test evaluations
+		self._eval_context = MappingProxyType(dict.fromkeys(reference_codes, 1.0) | FORMULA_FUNCTIONS)
 
-	def validate(self, row) -> ValidationResult:
+	def validate(self, row, result: ValidationResult | None = None) -> ValidationResult:
 		"""Validate calculation formula for a single row"""
-		result = ValidationResult()
+		if result is None:
+			result = ValidationResult()
 
 		if row.data_source != "Calculated Amount":
 			return result
@@ -307,7 +351,7 @@ class CalculationFormulaValidator(Validator):
 			return result
 
 		# Check self-reference
-		available_codes = list(self.reference_codes)
+		available_codes = self.reference_codes
 		refs = extract_reference_codes_from_formula(formula, available_codes)
 		if row.reference_code and row.reference_code in refs:
 			result.add_error(
@@ -318,7 +362,7 @@ class CalculationFormulaValidator(Validator):
 			)
 
 		# Check undefined references
-		undefined = set(refs) - set(available_codes)
+		undefined = set(refs) - available_codes
 		if undefined:
 			result.add_error(
 				ValidationIssue(
@@ -327,8 +371,10 @@ class CalculationFormulaValidator(Validator):
 				)
 			)
 
-		# Try to evaluate with dummy values
-		eval_error = self._test_formula_evaluation(formula, available_codes)
+		# Try to evaluate with dummy values, unless the formula is simple enough to always evaluate
+		eval_error = None
+		if not self._is_simple_formula(formula):
+			eval_error = self._test_formula_evaluation(formula)
 		if eval_error:
 			result.add_error(
 				ValidationIssue(
@@ -347,26 +393,55 @@ class CalculationFormulaValidator(Validator):
 
 	@staticmethod
 	def _are_parentheses_balanced(formula: str) -> bool:
-		return formula.count("(") == formula.count(")")
+		depth = 0
+		for char in formula:
+			if char == "(":
+				depth += 1
+			elif char == ")":
+				depth -= 1
+				if depth < 0:
+					# closed before being opened, e.g. `A) + (B`
+					return False
+
+		return depth == 0
+
+	@cached_property
+	def _simple_formula_pattern(self) -> re.Pattern | None:
+		"""
+		Pattern for formulas that always evaluate to a number with the dummy values,
+		e.g. `Revenue - COGS` or `A * 2 + B / C`: operands are plain identifier codes or
+		numbers joined by + - *, and only codes (never a literal) may follow a division.
+		"""
+		codes = sorted(
+			(
+				code
+				for code in self.reference_codes
+				if code.isidentifier()
+				and not code.startswith("_")
+				and not keyword.iskeyword(code)
+				and code not in FORMULA_FUNCTIONS
+			),
+			key=len,
+			reverse=True,
+		)
+		if not codes:
+			return None
 
-	def _test_formula_evaluation(self, formula: str, available_codes: list[str]) -> str | None:
-		try:
-			context = {code: 1.0 for code in available_codes}
-			context.update(
-				{
-					"abs": abs,
-					"round": round,
-					"min": min,
-					"max": max,
-					"sum": sum,
-					"sqrt": lambda x: x**0.5,
-					"pow": pow,
-					"ceil": lambda x: int(x) + (1 if x % 1 else 0),
-					"floor": lambda x: int(x),
-				}
-			)
+		code = r"(?:{})(?![\w.])".format("|".join(map(re.escape, codes)))
+		operand = rf"(?:{code}|{NUMBER_PATTERN}(?![\w.]))"
+		return re.compile(rf"\s*{operand}(?:\s*(?:[-+*]\s*{operand}|/\s*{code}))*\s*")
+
+	def _is_simple_formula(self, formula: str) -> bool:
+		# Such formulas cannot fail to evaluate, so safe_eval can be skipped for them
+		if not self.match_simple_formulas:
+			return False
 
-			result = frappe.safe_eval(formula, eval_globals=None, eval_locals=context)
+		pattern = self._simple_formula_pattern
+		return bool(pattern and pattern.fullmatch(formula))
+
+	def _test_formula_evaluation(self, formula: str) -> str | None:
+		try:
+			result = frappe.safe_eval(formula, eval_globals=None, eval_locals=self._eval_context)
 
 			if not isinstance(result, (int, float)):  # noqa: UP038
 				return f"Formula must return a numeric value, got {type(result).__name__}"
@@ -379,11 +454,12 @@ class CalculationFormulaValidator(Validator):
 class AccountFilterValidator(Validator):
 	"""Validates account filter expressions used in Account Data rows"""
 
-	def __init__(self, account_fields: set | None = None):
+	def __init__(self, account_fields: set | frozenset | None = None):
 		self.account_fields = account_fields or set(frappe.get_meta("Account")._valid_columns)
 
-	def validate(self, row) -> ValidationResult:
-		result = ValidationResult()
+	def validate(self, row, result: ValidationResult | None = None) -> ValidationResult:
+		if result is None:
+			result = ValidationResult()
 
 		if row.data_source != "Account Data":
 			return result
@@ -422,7 +498,7 @@ class AccountFilterValidator(Validator):
 
 		return result
 
-	def _validate_filter_structure(self, filter_config, account_fields: set) -> str | None:
+	def _validate_filter_structure(self, filter_config, account_fields: set | frozenset) -> str | None:
 		# simple condition: [field, operator, value]
 		if isinstance(filter_config, list):
 			if len(filter_config) != 3:
@@ -436,10 +512,11 @@ class AccountFilterValidator(Validator):
 			if field not in account_fields:
 				return f"Field '{field}' is not a valid account field"
 
-			if operator.casefold() not in OPERATOR_MAP:
+			operator_key = operator.casefold()
+			if operator_key not in OPERATOR_MAP:
 				return f"Invalid operator '{operator}'"
 
-			if operator in ["in", "not in"] and not isinstance(value, list):
+			if operator_key in LIST_VALUE_OPERATORS and not isinstance(value, list):
 				return f"Operator '{operator}' requires a list value"
 
 		# logical condition: {"and": [condition1, condition2]}
@@ -447,11 +524,11 @@ class AccountFilterValidator(Validator):
 			if len(filter_config) != 1:
 				return "Logical condition must have exactly one operator"
 
-			op = next(iter(filter_config.keys())).lower()
-			if op not in ["and", "or"]:
+			key = next(iter(filter_config))
+			if key.lower() not in LOGICAL_OPERATORS:
 				return "Logical operators must be 'and' or 'or'"
 
-			conditions = filter_config[next(iter(filter_config.keys()))]
+			conditions = filter_config[key]
 			if not isinstance(conditions, list) or len(conditions) < 1:
 				return "Logical conditions need at least 1 sub-condition"
 
@@ -467,34 +544,31 @@ class AccountFilterValidator(Validator):
 
 
 class FormulaValidator(Validator):
-	def __init__(self, template):
+	def __init__(self, template, account_fields: set | frozenset | None = None):
 		self.template = template
 		reference_codes = {row.reference_code for row in template.rows if row.reference_code}
-		self.calculation_validator = CalculationFormulaValidator(reference_codes)
-		self.account_filter_validator = AccountFilterValidator()
+		self.calculation_validator = CalculationFormulaValidator(reference_codes, match_simple_formulas=True)
+		self.account_filter_validator = AccountFilterValidator(account_fields)
 
-	def validate(self, row, account_fields: set) -> ValidationResult:
-		result = ValidationResult()
+	def validate(self, row, result: ValidationResult | None = None) -> ValidationResult:
+		if result is None:
+			result = ValidationResult()
 
 		if not row.calculation_formula:
 			return result
 
 		if row.data_source == "Calculated Amount":
-			return self.calculation_validator.validate(row)
+			self.calculation_validator.validate(row, result)
 
 		elif row.data_source == "Account Data":
-			# Update account fields if provided
-			if account_fields:
-				self.account_filter_validator.account_fields = account_fields
-			return self.account_filter_validator.validate(row)
+			self.account_filter_validator.validate(row, result)
 
 		elif row.data_source == "Custom API":
-			result.merge(self._validate_custom_api(row))
+			self._validate_custom_api(row, result)
 
 		return result
 
-	def _validate_custom_api(self, row) -> ValidationResult:
-		result = ValidationResult()
+	def _validate_custom_api(self, row, result: ValidationResult) -> ValidationResult:
 		api_path = row.calculation_formula
 
 		if "." not in api_path:
@@ -532,11 +606,26 @@ class FormulaValidator(Validator):
 		return result
 
 
-def extract_reference_codes_from_formula(formula: str, available_codes: list[str]) -> list[str]:
+def extract_reference_codes_from_formula(formula: str, available_codes: Iterable[str]) -> list[str]:
+	# A code made of word characters matches as a whole word exactly when it is one of
+	# the formula's word tokens, so one scan of the formula covers all such codes
+	tokens = set(WORD_PATTERN.findall(formula))
 	found_codes = []
 	for code in available_codes:
-		# Match complete words only to avoid partial matches
-		pattern = r"\b" + re.escape(code) + r"\b"
-		if re.search(pattern, formula):
+		if WORD_PATTERN.fullmatch(code):
+			if code in tokens:
+				found_codes.append(code)
+		elif get_reference_code_pattern(code).search(formula):
 			found_codes.append(code)
 	return found_codes
+
+
+@lru_cache(maxsize=2048)
+def get_reference_code_pattern(code: str) -> re.Pattern:
+	# Match complete words only to avoid partial matches
+	return re.compile(r"\b" + re.escape(code) + r"\b")
+
+
+@frappe.request_cache
+def get_account_fields() -> frozenset[str]:
+	return frozenset(field.fieldname for field in frappe.get_meta("Account").fields)
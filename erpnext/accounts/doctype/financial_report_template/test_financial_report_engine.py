@@ -9,6 +9,9 @@ from erpnext.accounts.doctype.financial_report_template.financial_report_engine
 	FilterExpressionParser,
 	FormulaCalculator,
 )
+from erpnext.accounts.doctype.financial_report_template.financial_report_validation import (
+	CalculationFormulaValidator,
+)
 from erpnext.accounts.doctype.financial_report_template.test_financial_report_template import (
 	FinancialReportTemplateTestCase,
 )
@@ -1214,6 +1217,50 @@ class TestFormulaCalculator(FinancialReportTemplateTestCase):
 		# Depends on currency precision
 		self.assertTrue(result[0] == 0.0 or abs(result[0] - expected) < 1e-6)
 
+	def test_validate_simple_formula_grammar(self):
+		"""Simple arithmetic formulas skip safe_eval during validation, everything else is evaluated"""
+		validator = CalculationFormulaValidator(
+			{"INC001", "EXP001", "NET-001", "sum"}, match_simple_formulas=True
+		)
+
+		simple_formulas = ["INC001 - EXP001", "INC001*2 + EXP001 / INC001", " 100 + 0.5 "]
+		for formula in simple_formulas:
+			with self.subTest(formula=formula):
+				self.assertTrue(validator._is_simple_formula(formula))
+				self.assertTrue(validator.validate(self._create_mock_report_row(formula)).is_valid)
+
+		other_formulas = [
+			"(INC001 + EXP001)",  # Parentheses
+			"INC001, EXP001",  # Tuple
+			"INC001 EXP001",  # Syntax error
+			"INC001 / 0",  # Division by a literal
+			"INC001 +",  # Dangling operator
+			"007 + INC001",  # Invalid literal
+			"NET-001 * 2",  # Code that is not an identifier
+			"sum + 1",  # Code shadowing a math function
+		]
+		for formula in other_formulas:
+			with self.subTest(formula=formula):
+				self.assertFalse(validator._is_simple_formula(formula))
+
+		# Rejected formulas still go through safe_eval
+		self.assertFalse(validator.validate(self._create_mock_report_row("INC001 / 0")).is_valid)
+
+		# Parentheses must be opened before they are closed, not just balanced in count
+		for formula in ["INC001) + (EXP001", "(INC001 + EXP001", "INC001 + EXP001)"]:
+			with self.subTest(formula=formula):
+				result = validator.validate(self._create_mock_report_row(formula))
+				self.assertIn(
+					"Formula has unbalanced parentheses", [issue.message for issue in result.issues]
+				)
+
+		self.assertTrue(validator.validate(self._create_mock_report_row("((INC001) + (EXP001))")).is_valid)
+
+		# Without the flag (as used by FormulaCalculator) the pattern is never compiled
+		validator = CalculationFormulaValidator({"INC001", "EXP001"})
+		self.assertTrue(validator.validate(self._create_mock_report_row("INC001 - EXP001")).is_valid)
+		self.assertNotIn("_simple_formula_pattern", validator.__dict__)
+
 	# 6. OTHER
 	def test_prevent_security_vulnerabilities(self):
 		row_data = {"TEST_VAL": [100.0]}
@@ -1407,6 +1454,15 @@ class TestFilterExpressionParser(FinancialReportTemplateTestCase):
 		condition = parser.build_condition(mock_row_in, account_table)
 		self.assertIsNotNone(condition)  # Should work with list
 
+		# Operators are case insensitive, "IN" also requires a list value
+		for formula in ['["account_type", "IN", "Income"]', '["account_type", "Not In", "Income"]']:
+			with self.subTest(formula=formula):
+				mock_row = self._create_mock_report_row(formula)
+				result = parser.validator.validate(mock_row)
+				self.assertFalse(result.is_valid)
+				self.assertIn("requires a list value", result.issues[0].message)
+				self.assertIsNone(parser.build_condition(mock_row, account_table))
+
 		# Test numeric operators with proper values
 		numeric_formulas = [
 			'["tax_rate", ">", 10.0]',
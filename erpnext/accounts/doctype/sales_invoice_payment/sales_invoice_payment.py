@@ -2,6 +2,7 @@
 # For license information, please see license.txt
 
 
+import frappe
 from frappe.model.document import Document
 
 
@@ -28,3 +29,7 @@ class SalesInvoicePayment(Document):
 	# end: auto-generated types
 
 	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Sales Invoice Payment", ["account", "parent"])
@@ -6,7 +6,12 @@ from frappe.query_builder import Criterion
 from frappe.query_builder.functions import IfNull, Sum
 from frappe.utils import fmt_money
 
-from erpnext.accounts.doctype.budget.budget import BudgetError, get_accumulated_monthly_budget
+from erpnext.accounts.doctype.budget.budget import (
+	BudgetError,
+	get_accumulated_monthly_budget,
+	get_user_roles,
+	prefetch_budget_distribution,
+)
 from erpnext.accounts.utils import get_fiscal_year
 
 
@@ -77,6 +82,7 @@ class BudgetValidation:
 
 	def build_to_validate_map(self):
 		self.to_validate = frappe._dict()
+		prefetch_budget_distribution([self.budget_map[key].name for key in self.overlap])
 		for key in self.overlap:
 			self.to_validate[key] = self.initialize_dict(key)
 
@@ -292,7 +298,7 @@ class BudgetValidation:
 		frappe.msgprint(msg, _("Budget Exceeded"))
 
 	def execute_action(self, action, msg):
-		if self.exception_approver_role and self.exception_approver_role in frappe.get_roles(
+		if self.exception_approver_role and self.exception_approver_role in get_user_roles(
 			frappe.session.user
 		):
 			self.warn(msg)